@@ -94,6 +94,56 @@ def main(argv=sys.argv):
         nargs='*',
         help='Name of synchronized devices to mount'
     ).completer = DeviceCompleter
+    parser_mount.add_argument(
+        '--cache-size',
+        type=int,
+        help='Maximum size (in MB) of the local cache for file contents'
+    )
+    parser_mount.add_argument(
+        '--block-size',
+        type=int,
+        help='Size (in KB) of the file parts fetched from the database'
+    )
+    parser_mount.add_argument(
+        '--readahead',
+        type=int,
+        help='Number of blocks fetched in advance when a file is read '
+             'sequentially (0 to disable)'
+    )
+    parser_mount.add_argument(
+        '--write-back',
+        action='store_true',
+        help='Save closed files to the database in background'
+    )
+    parser_mount.add_argument(
+        '--multithreaded',
+        action='store_true',
+        help='Handle file system operations concurrently'
+    )
+    parser_mount.add_argument(
+        '--attr-timeout',
+        type=float,
+        help='Delay (in seconds) during which the kernel caches file '
+             'attributes and lookups'
+    )
+
+    # "gc" action
+    parser_gc = subparsers.add_parser(
+        'gc',
+        help='Remove file contents left without file in the local database.'
+    )
+    parser_gc.set_defaults(func=actions.collect_garbage)
+
+    parser_gc.add_argument(
+        'devices',
+        nargs='*',
+        help='Name of devices to clean'
+    ).completer = DeviceCompleter
+    parser_gc.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Only count file contents to remove'
+    )
 
     # "unmount" action
     parser_unmount = subparsers.add_parser(
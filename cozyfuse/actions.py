@@ -11,8 +11,6 @@ import local_config
 import remote
 import dbutils
 
-from couchdb import Server
-
 
 def query_yes_no(question, default='yes'):
     '''
@@ -111,7 +109,7 @@ def kill_running_replications():
     Useful when a replication is in Zombie mode.
     '''
 
-    server = Server('http://localhost:5984/')
+    server = dbutils.get_server()
 
     for task in server.tasks():
         data = {
@@ -174,10 +172,25 @@ def reset():
     print '[reset] Configuration files deleted, folder unmounted.'
 
 
-def mount_folder(devices=[]):
+def mount_folder(devices=[], cache_size=None, block_size=None,
+                 readahead=None, write_back=False, multithreaded=False,
+                 attr_timeout=None):
     '''
     Mount folder linked to given device.
+    *cache_size* is the maximum size of the local binary cache, in MB.
+    *block_size* is the size of file parts fetched from the database, in KB.
+    *readahead* is the number of blocks fetched in advance for sequential
+    reads.
+    If *write_back* is True, closed files are saved in background.
+    If *multithreaded* is True, file system operations run concurrently.
+    *attr_timeout* is the delay, in seconds, during which the kernel caches
+    attributes and lookups.
     '''
+    if cache_size is not None:
+        cache_size = cache_size * 1024 * 1024
+    if block_size is not None:
+        block_size = block_size * 1024
+
     if len(devices) == 0:
         devices = local_config.get_default_devices()
 
@@ -197,7 +210,12 @@ def mount_folder(devices=[]):
                     pass
                 else:
                     continue
-            couchmount.mount(name, path)
+            couchmount.mount(name, path,
+                             cache_size=cache_size, block_size=block_size,
+                             readahead_window=readahead,
+                             write_back=write_back,
+                             multithreaded=multithreaded,
+                             attr_timeout=attr_timeout)
         except KeyboardInterrupt:
             unmount_folder(name)
 
@@ -256,7 +274,7 @@ def unregister_device(device):
     (device_id, device_password) = local_config.get_device_config(device)
 
     print 'Cozy connection removal for %s.' % device
-    local_config.remove(device)
+    local_config.remove_config(device)
     print '- Local configuration removed.'
     dbutils.remove_db(device)
     print '- Local files removed.'
@@ -330,3 +348,22 @@ def sync(devices=[]):
                 replication.BinaryReplication(name)
         except KeyboardInterrupt:
             print ' Binary Synchronization interrupted.'
+
+
+def collect_garbage(devices=[], dry_run=False):
+    '''
+    Remove binaries no file refers to from the database of given devices.
+    Removals are replicated to the remote Cozy.
+    If *dry_run* is True, binaries are only counted.
+    '''
+    if len(devices) == 0:
+        devices = local_config.get_default_devices()
+
+    for name in devices:
+        db = dbutils.get_db(name)
+        orphans = dbutils.get_orphan_binaries(db)
+        print '[gc] %s binaries without file found for %s' % (
+            len(orphans), name)
+        if orphans and not dry_run:
+            errors = dbutils.delete_docs_by_id(db, orphans)
+            print '[gc] %s binaries removed' % (len(orphans) - len(errors))
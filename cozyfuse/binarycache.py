@@ -0,0 +1,427 @@
+import os
+import errno
+import hashlib
+import logging
+import threading
+
+from collections import OrderedDict
+
+import dbutils
+import local_config
+
+from couchdb import ResourceNotFound
+from couchdb.http import Resource, ServerError, Session
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+# Default maximum size of the cache folder (in bytes).
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+# Default size of the blocks fetched from the database (in bytes).
+DEFAULT_BLOCK_SIZE = 256 * 1024
+CHUNK_SIZE = 64 * 1024
+# Number of downloads of missing blocks before giving up a read.
+FETCH_ATTEMPTS = 3
+
+
+class CacheEntry():
+    '''
+    Cached content of a binary revision. Content is stored in a sparse data
+    file, blocks fetched so far are listed in an index file (one
+    "first last" range per line after a "length block_size" header).
+    '''
+
+    def __init__(self, path, length, block_size):
+        self.path = path
+        self.index_path = path + '.blocks'
+        self.length = length
+        self.block_size = block_size
+        self.blocks = set()
+        self.size = 0
+
+    def block_count(self):
+        return (self.length + self.block_size - 1) // self.block_size
+
+    def create(self):
+        '''
+        Create empty data file and index file.
+        '''
+        open(self.path, 'wb').close()
+        with open(self.index_path, 'w') as index:
+            index.write('%s %s\n' % (self.length, self.block_size))
+
+    def add_blocks(self, first, last):
+        '''
+        Mark blocks *first* to *last* (included) as present.
+        '''
+        added = set(range(first, last + 1)) - self.blocks
+        self.blocks.update(added)
+        for block in added:
+            self.size += self._get_block_length(block)
+        with open(self.index_path, 'a') as index:
+            index.write('%s %s\n' % (first, last))
+
+    def remove(self):
+        for path in [self.path, self.index_path]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _get_block_length(self, block):
+        return min(self.block_size, self.length - block * self.block_size)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Read entry from its index file. Return None if the index is not
+        readable.
+        '''
+        try:
+            with open(path + '.blocks') as index:
+                (length, block_size) = map(int, index.readline().split())
+                entry = cls(path, length, block_size)
+                for line in index:
+                    (first, last) = map(int, line.split())
+                    entry.blocks.update(range(first, last + 1))
+        except (IOError, ValueError):
+            return None
+
+        entry.size = sum(map(entry._get_block_length, entry.blocks))
+        return entry
+
+
+class BinaryCache():
+    '''
+    On-disk cache for binary attachments, stored in
+    ~/.cozyfuse/<device>/cache.
+
+    Each entry holds the content of a binary document at a given revision.
+    Entries are content addressed (named after a hash of the binary id and
+    revision), so an entry never has to be invalidated: a new revision simply
+    produces a new entry and old ones are evicted when the cache exceeds its
+    maximum size (least recently used first).
+
+    Content is fetched block by block with HTTP Range requests, so only the
+    parts of a file that are actually read are downloaded.
+    '''
+
+    def __init__(self, db, device, max_size=DEFAULT_CACHE_SIZE,
+                 block_size=DEFAULT_BLOCK_SIZE):
+        self.resource = _get_uncached_resource(db)
+        self.folder = os.path.join(local_config.CONFIG_FOLDER, device, 'cache')
+        self.max_size = max_size
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        # Entry name -> entry, ordered from least to most recently used.
+        self.entries = OrderedDict()
+        # (entry name, block) -> event set when block download is over.
+        self.fetching = {}
+        self.size = 0
+
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        self._load_entries()
+
+    def read(self, binary_id, rev, size, offset):
+        '''
+        Return *size* bytes of the binary content starting at *offset*.
+        Missing blocks are downloaded first.
+        '''
+        first = offset // self.block_size
+        last = (offset + max(size, 1) - 1) // self.block_size
+        entry = self.fetch(binary_id, rev, first, last)
+
+        if entry is None or offset >= entry.length:
+            return ''
+
+        with open(entry.path, 'rb') as data:
+            data.seek(offset)
+            return data.read(size)
+
+    def add(self, binary_id, rev, content):
+        '''
+        Store *content* (an object providing size and stream()) as the
+        content of given binary revision, when it has just been uploaded.
+        '''
+        name = _get_entry_name(binary_id, rev)
+        entry = self._create_entry(name, content.size)
+        stream = content.stream()
+        with open(entry.path, 'r+b') as data:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                data.write(chunk)
+
+        if entry.length > 0:
+            with self.lock:
+                previous_size = entry.size
+                entry.add_blocks(0, entry.block_count() - 1)
+                self.size += entry.size - previous_size
+                self._evict(keep=name)
+
+    def fetch(self, binary_id, rev, first, last):
+        '''
+        Make sure blocks *first* to *last* of given binary revision are in
+        the cache. Blocks already being downloaded by another thread are
+        waited for instead of being downloaded twice.
+        Return the cache entry or None if the binary has no attachment.
+        Raise IOError (EIO) when the binary revision is not in the database
+        or when the blocks are still missing after FETCH_ATTEMPTS
+        downloads.
+        '''
+        name = _get_entry_name(binary_id, rev)
+        with self.lock:
+            entry = self._touch(name)
+
+        if entry is None:
+            entry = self._fill(name, binary_id, rev, first, last)
+            if entry is None:
+                return None
+
+        last = min(last, entry.block_count() - 1)
+        attempts = 0
+        while True:
+            done = threading.Event()
+            with self.lock:
+                missing = [block for block in range(first, last + 1)
+                           if block not in entry.blocks]
+                if not missing:
+                    return entry
+                waits = set(self.fetching[(name, block)] for block in missing
+                            if (name, block) in self.fetching)
+                blocks = [block for block in missing
+                          if (name, block) not in self.fetching]
+                if blocks:
+                    # Transfers may stop early, leaving blocks missing.
+                    if attempts == FETCH_ATTEMPTS:
+                        raise IOError(
+                            errno.EIO,
+                            'Cannot fetch blocks %s to %s of binary %s' %
+                            (blocks[0], blocks[-1], binary_id))
+                    attempts += 1
+                for block in blocks:
+                    self.fetching[(name, block)] = done
+
+            try:
+                for (start, end) in _get_ranges(blocks):
+                    self._fill(name, binary_id, rev, start, end, entry)
+            finally:
+                with self.lock:
+                    for block in blocks:
+                        del self.fetching[(name, block)]
+                done.set()
+
+            # Check again once downloads are done, in case they failed or
+            # stopped early.
+            for event in waits:
+                event.wait()
+
+    def _fill(self, name, binary_id, rev, first, last, entry=None):
+        '''
+        Download blocks *first* to *last* of given binary revision into the
+        cache entry, create the entry if *entry* is None.
+        Return the entry or None if the binary has no attachment.
+        '''
+        start = first * self.block_size
+        end = (last + 1) * self.block_size - 1
+        params = {}
+        if rev:
+            params['rev'] = rev
+        resource = self.resource(binary_id, 'file')
+
+        try:
+            (status, headers, body) = resource.get(
+                headers={'Range': 'bytes=%s-%s' % (start, end)}, **params)
+        except ResourceNotFound:
+            # The binary revision may not be replicated yet, its content is
+            # not known: it must not be taken as an empty content.
+            try:
+                self.resource(binary_id).head(**params)
+            except ResourceNotFound:
+                raise IOError(errno.EIO, 'Binary %s (%s) not found' % (
+                    binary_id, rev))
+            logger.info('No attachment for binary %s' % binary_id)
+            return None
+        except ServerError as e:
+            # Range starts after the end of the content.
+            if e.args[0][0] != 416:
+                raise
+            (status, headers, body) = resource.head(**params)
+            start = 0
+            length = int(headers['content-length'])
+        else:
+            if status == 206:
+                length = int(headers['content-range'].rsplit('/', 1)[1])
+            else:
+                # Server does not support ranges for this attachment, the
+                # whole content is sent.
+                start = 0
+                length = int(headers['content-length'])
+
+        if entry is None:
+            entry = self._create_entry(name, length)
+
+        written = 0
+        with open(entry.path, 'r+b') as data:
+            data.seek(start)
+            while body is not None:
+                chunk = body.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                data.write(chunk)
+                written += len(chunk)
+        if body is not None:
+            body.close()
+
+        # Only complete blocks are marked, in case the transfer stopped in
+        # the middle of a block.
+        end = start + written
+        if end < entry.length:
+            end -= end % self.block_size
+        if end > start:
+            with self.lock:
+                previous_size = entry.size
+                entry.add_blocks(start // self.block_size,
+                                 (end - 1) // self.block_size)
+                if name in self.entries:
+                    self.size += entry.size - previous_size
+                    self._evict(keep=name)
+        logger.debug('Binary %s (%s) cached, %s bytes at %s' %
+                     (binary_id, rev, written, start))
+        return entry
+
+    def _create_entry(self, name, length):
+        '''
+        Create and register an empty entry for content of size *length*.
+        '''
+        entry = CacheEntry(
+            os.path.join(self.folder, name), length, self.block_size)
+        with self.lock:
+            if name in self.entries:
+                return self.entries[name]
+            entry.create()
+            self.entries[name] = entry
+        return entry
+
+    def _touch(self, name):
+        '''
+        Mark entry as the most recently used and return it. Must be called
+        with the lock held.
+        '''
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.entries[name] = entry
+            os.utime(entry.path, None)
+        return entry
+
+    def _evict(self, keep=None):
+        '''
+        Remove least recently used entries until the cache fits in its
+        maximum size. Must be called with the lock held.
+        '''
+        for name in list(self.entries.keys()):
+            if self.size <= self.max_size:
+                break
+            if name == keep:
+                continue
+            entry = self.entries.pop(name)
+            self.size -= entry.size
+            entry.remove()
+
+    def _load_entries(self):
+        '''
+        Index entries left by a previous mount, ordered by last use.
+        Entries fetched with another block size are removed.
+        '''
+        entries = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if name.endswith('.blocks'):
+                if not os.path.exists(path[:-len('.blocks')]):
+                    os.remove(path)
+                continue
+            entry = CacheEntry.load(path)
+            if entry is None or entry.block_size != self.block_size:
+                os.remove(path)
+                if entry is not None:
+                    entry.remove()
+            else:
+                entries.append((os.stat(path).st_mtime, name, entry))
+
+        for (mtime, name, entry) in sorted(entries):
+            self.entries[name] = entry
+            self.size += entry.size
+
+        with self.lock:
+            self._evict()
+
+
+class BinaryContent():
+    '''
+    Content of a binary revision, read through the cache.
+    '''
+
+    def __init__(self, binary_cache, binary_id, rev):
+        self.binary_cache = binary_cache
+        self.binary_id = binary_id
+        self.rev = rev
+
+    def get_size(self):
+        entry = self.binary_cache.fetch(self.binary_id, self.rev, 0, 0)
+        if entry is None:
+            return 0
+        return entry.length
+
+    def read(self, size, offset):
+        return self.binary_cache.read(self.binary_id, self.rev, size, offset)
+
+
+class NoCache():
+    '''
+    HTTP cache that never stores anything. The default cache of CouchDB
+    sessions is keyed by URL and revalidated with ETags, which would return
+    the wrong part of an attachment for Range requests.
+    '''
+
+    def get(self, url):
+        return None
+
+    def put(self, url, response):
+        pass
+
+    def remove(self, url):
+        pass
+
+
+def _get_uncached_resource(db):
+    '''
+    Return a resource on given database that does not cache responses.
+    Idle connections are bounded like those of the database sessions.
+    '''
+    session = Session(cache=NoCache())
+    session.connection_pool = dbutils.ConnectionPool()
+    resource = Resource(db.resource.url, session)
+    resource.credentials = db.resource.credentials
+    return resource
+
+
+def _get_entry_name(binary_id, rev):
+    '''
+    Return cache entry name for given binary revision.
+    '''
+    return hashlib.sha1('%s@%s' % (binary_id, rev)).hexdigest()
+
+
+def _get_ranges(blocks):
+    '''
+    Return ranges of consecutive blocks from given sorted block list.
+    '''
+    ranges = []
+    for block in blocks:
+        if ranges and ranges[-1][1] == block - 1:
+            ranges[-1] = (ranges[-1][0], block)
+        else:
+            ranges.append((block, block))
+    return ranges
@@ -10,19 +10,28 @@
 
 import os
 import sys
+import stat
+import base64
 import platform
 import errno
 import fuse
 import subprocess
 import logging
 import datetime
+import threading
 import mimetypes
+import copy
 import tree
 
 import dbutils
 import local_config
+import binarycache
+import readahead
+import writebuffer
+import journal
+import folderdates
 
-from couchdb import ResourceNotFound
+from couchdb import ResourceConflict, ResourceNotFound
 
 DEVNULL = open(os.devnull, 'wb')
 
@@ -37,6 +46,14 @@ logger.addHandler(HDLR)
 logger.setLevel(logging.INFO)
 
 
+# Maximum size (in bytes) of contents sent with a new binary document
+# instead of being uploaded separately.
+INLINE_BINARY_SIZE = 64 * 1024
+# Delay (in seconds) during which the kernel reuses attributes and path
+# lookups without asking the file system again.
+DEFAULT_ATTR_TIMEOUT = 5
+
+
 def get_current_date():
     """
     Get current date : Return current date with format 'Y-m-d T H:M:S'
@@ -52,9 +69,22 @@ class CouchFSDocument(fuse.Fuse):
     change occurs or when users want to access to his/her file system.
    '''
 
-    def __init__(self, database, mountpoint, uri=None, *args, **kwargs):
+    def __init__(self, database, mountpoint, uri=None, cache_size=None,
+                 block_size=None, readahead_window=None, write_back=False,
+                 attr_timeout=None, *args, **kwargs):
         '''
         Configure file system, database and store remote Cozy informations.
+            cache_size {integer}: maximum size (in bytes) of the local cache
+                                  for binaries.
+            block_size {integer}: size (in bytes) of the binary parts fetched
+                                  from the database.
+            readahead_window {integer}: number of blocks downloaded in
+                                        advance when a file is read
+                                        sequentially.
+            write_back {boolean}: if True, closed files are saved to the
+                                  database in background.
+            attr_timeout {number}: delay (in seconds) during which the
+                                   kernel caches attributes and lookups.
         '''
         logger.info('Mounting folder...')
 
@@ -62,11 +92,19 @@ class CouchFSDocument(fuse.Fuse):
         fuse.Fuse.__init__(self, *args, **kwargs)
         self.fuse_args.mountpoint = mountpoint
         self.fuse_args.add('allow_other')
+        # Inodes are derived from document ids, so the kernel can cache
+        # attributes and lookups. Changes made by other devices become
+        # visible when these caches expire.
+        if attr_timeout is None:
+            attr_timeout = DEFAULT_ATTR_TIMEOUT
+        self.fuse_args.add('use_ino')
+        self.fuse_args.add('attr_timeout', str(attr_timeout))
+        self.fuse_args.add('entry_timeout', str(attr_timeout))
         self.currentFile = None
 
-        # Configure database
+        # Configure database, FUSE threads share a pool of connections.
         self.database = database
-        (self.db, self.server) = dbutils.get_db_and_server(database)
+        self.databases = dbutils.Databases(database)
 
         # Configure Cozy
         device = dbutils.get_device(database)
@@ -89,7 +127,54 @@ class CouchFSDocument(fuse.Fuse):
         )
         # init cache
         self.cache = tree.Cache(database)
+        # Lock for writeBuffers and openFiles, FUSE operations may run in
+        # several threads.
+        self.lock = threading.RLock()
         self.writeBuffers = {}
+        self.openFiles = {}
+        self.buffer_folder = os.path.join(CONFIG_FOLDER, database, 'buffers')
+        writebuffer.clean(self.buffer_folder)
+        if cache_size is None:
+            cache_size = binarycache.DEFAULT_CACHE_SIZE
+        if block_size is None:
+            block_size = binarycache.DEFAULT_BLOCK_SIZE
+        self.binary_cache = binarycache.BinaryCache(
+            self.db, database, cache_size, block_size)
+        if readahead_window is None:
+            readahead_window = readahead.DEFAULT_WINDOW
+        self.readahead = readahead.ReadAhead(
+            self.binary_cache, readahead_window)
+        if write_back:
+            self.journal = journal.Journal(
+                os.path.join(CONFIG_FOLDER, database, 'journal'),
+                self._save_file)
+        else:
+            self.journal = None
+        self.folder_dates = folderdates.FolderDates(self._save_folder_dates)
+
+    @property
+    def db(self):
+        return self.databases.db
+
+    @property
+    def server(self):
+        return self.databases.server
+
+    def fsinit(self):
+        """
+        Start background tasks, once the file system is mounted.
+        """
+        self.cache.start()
+        self.folder_dates.start()
+        if self.journal is not None:
+            self.journal.start()
+
+    def fsdestroy(self):
+        """
+        Save state needed by next mount, when the file system is unmounted.
+        """
+        self.folder_dates.flush()
+        self.cache.save_snapshot()
 
     def readdir(self, path, offset):
         """
@@ -101,9 +186,11 @@ class CouchFSDocument(fuse.Fuse):
 
         # this two folders are conventional in Unix system.
         for directory in '.', '..':
-            yield fuse.Direntry(directory)
-        for name in self.cache.get_children(path):
-            yield fuse.Direntry(name.encode('utf-8'))
+            yield fuse.Direntry(directory, type=stat.S_IFDIR >> 12)
+        # Type and inode are given with each entry, so the kernel does not
+        # need a getattr per entry to know what kind of file it is.
+        for (name, file_type, inode) in self.cache.get_entries(path):
+            yield fuse.Direntry(name, type=file_type, ino=inode)
 
     def getattr(self, path):
         """
@@ -112,7 +199,14 @@ class CouchFSDocument(fuse.Fuse):
         """
         try:
             logger.debug('getattr %s' % path)
-            return self.cache.get_st(path)
+            st = self.cache.get_st(path)
+            if st is None:
+                return -errno.ENOENT
+            content = self._get_pending_content(path)
+            if content is not None:
+                st = copy.copy(st)
+                st.st_size = content.get_size()
+            return st
         except Exception as e:
             logger.exception(e)
             return -errno.ENOENT
@@ -128,6 +222,9 @@ class CouchFSDocument(fuse.Fuse):
             found = self.cache.find_file(folder_path, name)
             if found:
                 logger.info('%s found' % path)
+                path = _normalize_path(path)
+                with self.lock:
+                    self.openFiles[path] = self.openFiles.get(path, 0) + 1
                 return 0
             else:
                 logger.error('File not found %s' % path)
@@ -144,32 +241,25 @@ class CouchFSDocument(fuse.Fuse):
             size {integer}: size of file part to read
             offset {integer}: beginning of file part to read
         """
-        # TODO: do not load the file for each chunk.
-        # Save it in a cache file maybe?.
         try:
             path = _normalize_path(path)
-            logger.info('read %s, %s, %s' % (path, size, offset))
-            binary_id = self.cache.get_binary(path)
-            binary_attachment = self.db.get_attachment(binary_id, "file")
-            logger.info(binary_id)
-
-            if binary_attachment is None:
-                logger.info('No attachment for this binary')
+            logger.debug('read %s, %s, %s' % (path, size, offset))
+            content = self._get_pending_content(path)
+            if content is not None:
+                return content.read(size, offset)
+
+            binary = self.cache.get_binary(path)
+            if not binary:
+                logger.info('No binary for this file')
                 return ''
 
             else:
-                content = binary_attachment.read()
-                content_length = len(content)
-                if offset < content_length:
-                    if offset + size > content_length:
-                        size = content_length - offset
-                    buf = content[offset:offset + size]
-
-                else:
-                    buf = ''
-                    logger.info('Empty file content')
+                return self.readahead.read(
+                    path, binary['id'], binary.get('rev'), size, offset)
 
-                return buf
+        except IOError as e:
+            logger.exception(e)
+            return -errno.EIO
 
         except Exception as e:
             logger.exception(e)
@@ -180,13 +270,16 @@ class CouchFSDocument(fuse.Fuse):
         Write data in file located at given path.
             path {string}: file path
             buf {buffer}: data to write
+            offset {integer}: position where data are written
         """
-        path = _normalize_path(path)
-        logger.info('write %s' % path)
-        if path not in self.writeBuffers:
-            self.writeBuffers[path] = ''
-        self.writeBuffers[path] = self.writeBuffers[path] + buf
-        return len(buf)
+        try:
+            path = _normalize_path(path)
+            logger.debug('write %s, %s, %s' % (path, len(buf), offset))
+            return self._get_write_buffer(path).write(buf, offset)
+
+        except Exception as e:
+            logger.exception(e)
+            return -errno.EIO
 
     def release(self, path, fuse_file_info):
         """
@@ -197,25 +290,21 @@ class CouchFSDocument(fuse.Fuse):
             Release is called when there are no more references
             to an open file: all file descriptors are closed and
             all memory mappings are unmapped.
+
+            Modified content is saved once the file is closed by every
+            process that opened it.
         """
         try:
             path = _normalize_path(path)
             logger.info('release file %s' % path)
-            file_doc = dbutils.get_file(self.db, path)
-            binary_id = file_doc["binary"]["file"]["id"]
+            self.readahead.forget(path)
 
-            if path in self.writeBuffers:
-                data = self.writeBuffers[path]
-                self.db.put_attachment(self.db[binary_id],
-                                       data,
-                                       filename="file")
-                file_doc['size'] = len(data)
-                file_doc['lastModification'] = get_current_date()
-                self.writeBuffers.pop(path, None)
-
-                binary = self.db[binary_id]
-                file_doc['binary']['file']['rev'] = binary['_rev']
-                self.db.save(file_doc)
+            with self.lock:
+                count = self.openFiles.pop(path, 1) - 1
+                if count > 0:
+                    self.openFiles[path] = count
+            if count <= 0:
+                self._save_write_buffer(path)
 
             logger.info("release is done")
             return 0
@@ -226,9 +315,9 @@ class CouchFSDocument(fuse.Fuse):
 
     def mknod(self, path, mode, dev):
         """
-        Create special/ordinary file. Since it's a new file, the file and
-        and the binary metadata are created in the database. Then file is saved
-        as an attachment to the database.
+        Create special/ordinary file. Since it's a new file, the file
+        metadata are created in the database. The binary is created when
+        content is written to the file.
             path {string}: file path
             mode {string}: file permissions
             dev: if the file type is S_IFCHR or S_IFBLK, dev specifies the
@@ -241,28 +330,22 @@ class CouchFSDocument(fuse.Fuse):
             (file_path, name) = _path_split(path)
 
             file_path = _normalize_path(file_path)
-            new_binary = {"docType": "Binary"}
-            binary_id = self.db.create(new_binary)
-            self.db.put_attachment(self.db[binary_id], '', filename="file")
             (mime_type, encoding) = mimetypes.guess_type(path)
-
-            rev = self.db[binary_id]["_rev"]
+            # The binary is created when content is saved for the first
+            # time, an empty file has no binary.
             now = get_current_date()
             newFile = {
+                "_id": dbutils.get_new_id(),
                 "name": name,
                 "path": _normalize_path(file_path),
-                "binary": {
-                    "file": {
-                        "id": binary_id,
-                        "rev": rev
-                    }
-                },
                 "docType": "File",
                 "mime": mime_type,
+                "size": 0,
                 'creationDate': now,
                 'lastModification': now,
             }
-            self.db.create(newFile)
+            dbutils.create_docs(self.db, [newFile])
+            self.cache.add_document(newFile)
             logger.info("file created")
             self._update_parent_folder(newFile['path'])
             logger.info('mknod is done for %s' % path)
@@ -285,16 +368,24 @@ class CouchFSDocument(fuse.Fuse):
             else:
                 dirname, filename = parts
 
+            if self.journal is not None:
+                self.journal.discard(path)
+
             file_doc = dbutils.get_file(self.db, path)
             if file_doc is not None:
-                binary_id = file_doc["binary"]["file"]["id"]
-                logger.info(self.db[file_doc["_id"]])
-
-                try:
-                    self.db.delete(self.db[binary_id])
-                except ResourceNotFound:
-                    pass
-                self.db.delete(self.db[file_doc["_id"]])
+                # File and binary are deleted with a single request.
+                docs = [file_doc]
+                binary = file_doc.get("binary", {}).get("file")
+                if binary is not None:
+                    docs.append({"_id": binary["id"],
+                                 "_rev": binary.get("rev")})
+                errors = dbutils.delete_docs(self.db, docs)
+                if file_doc["_id"] in errors:
+                    return -errno.EIO
+                if binary is not None and binary["id"] in errors:
+                    # File document was not up to date with its binary.
+                    dbutils.delete_docs_by_id(self.db, [binary["id"]])
+                self.cache.delete_document(file_doc)
                 logger.info('file %s removed' % path)
                 self._update_parent_folder(file_doc['path'])
                 return 0
@@ -307,10 +398,23 @@ class CouchFSDocument(fuse.Fuse):
             return -errno.ENOENT
 
     def truncate(self, path, size):
-        """ TODO: look if something should be done there.
-        Change size of a file.
         """
-        return 0
+        Change size of a file. If the file is not open, new content is saved
+        right away, else it is saved when the file is released.
+        """
+        try:
+            path = _normalize_path(path)
+            logger.info('truncate %s, %s' % (path, size))
+            self._get_write_buffer(path).truncate(size)
+            with self.lock:
+                is_open = path in self.openFiles
+            if not is_open:
+                self._save_write_buffer(path)
+            return 0
+
+        except Exception as e:
+            logger.exception(e)
+            return -errno.EIO
 
     def utime(self, path, times):
         """ TODO: look if something should be done there.
@@ -336,13 +440,15 @@ class CouchFSDocument(fuse.Fuse):
                 logger.info('folder already exists %s' % path)
                 return -errno.EEXIST
             else:
-                self.db.create({
+                folder = {
                     "name": name,
                     "path": folder_path,
                     "docType": "Folder",
                     'creationDate': now,
                     'lastModification': now,
-                })
+                }
+                self.db.save(folder)
+                self.cache.add_document(folder)
 
                 self._update_parent_folder(folder_path)
                 return 0
@@ -353,13 +459,26 @@ class CouchFSDocument(fuse.Fuse):
 
     def rmdir(self, path):
         """
-        Delete folder from database.
+        Delete empty folder from database.
             path {string}: diretory path
         """
         try:
             path = _normalize_path(path)
+            if self.cache.get_children(path):
+                return -errno.ENOTEMPTY
             folder = dbutils.get_folder(self.db, path)
-            self.db.delete(self.db[folder['_id']])
+            if folder is None:
+                return -errno.ENOENT
+            # Content replicated from the remote Cozy may not be in the tree
+            # yet, if the listener did not apply it.
+            if dbutils.get_descendants(self.db, path):
+                return -errno.ENOTEMPTY
+
+            if dbutils.delete_docs(self.db, [folder]):
+                logger.error('Cannot delete folder %s' % path)
+                return -errno.EIO
+            self.cache.delete_document(folder)
+            self.folder_dates.discard(path)
             return 0
 
         except Exception as e:
@@ -368,62 +487,93 @@ class CouchFSDocument(fuse.Fuse):
 
     def rename(self, pathfrom, pathto, root=True):
         """
-        Rename file and subfiles (if it's a folder) in database.
+        Rename file and subfiles (if it's a folder) in database. Documents
+        of a folder content are fetched and saved in bulk.
         """
         logger.info("path rename %s -> %s: " % (pathfrom, pathto))
         pathfrom = _normalize_path(pathfrom)
         pathto = _normalize_path(pathto)
 
-        for doc in self.db.view("file/byFullPath", key=pathfrom):
-            doc = doc.value
-            (file_path, name) = _path_split(pathto)
+        # Last modification date of both parent folders changes, they are
+        # saved with the moved documents.
+        (file_path, name) = _path_split(pathto)
+        (file_path_from, name_from) = _path_split(pathfrom)
+        if root:
+            parent_folders = [file_path, file_path_from]
+        else:
+            parent_folders = []
+
+        for doc in self.db.view("file/byFullPath", key=pathfrom,
+                                include_docs=True):
+            doc = doc.doc
             doc.update({
                 "name": name,
                 "path": file_path,
                 "lastModification": get_current_date(
                 )})
-            self.db.save(doc)
-            if root:
-                self._update_parent_folder(file_path)
-                # Change lastModification for file_path_from in case of file
-                # was moved
-                (file_path_from, name) = _path_split(pathfrom)
-                self._update_parent_folder(file_path_from)
+            if self._save_with_parents([doc], parent_folders):
+                return -errno.EIO
+            self._move_pending(pathfrom, pathto, root)
             return 0
 
-        for doc in self.db.view("folder/byFullPath", key=pathfrom):
-            doc = doc.value
-            (file_path, name) = _path_split(pathto)
+        folder = dbutils.get_folder(self.db, pathfrom)
+        if folder is None:
+            return -errno.ENOENT
+        self.folder_dates.move(pathfrom, pathto)
+        date = get_current_date()
+        folder.update({
+            "name": name,
+            "path": file_path,
+            "lastModification": date
+        })
+
+        # Move all subfiles and subfolders: their path starts with the
+        # folder path, only this prefix changes.
+        prefix_from = pathfrom.decode('utf-8')
+        prefix_to = pathto.decode('utf-8')
+        docs = [folder]
+        moves = []
+        for doc in dbutils.get_descendants(self.db, pathfrom):
+            path_from = _encode(doc['path'] + '/' + doc['name'])
             doc.update({
-                "name": name,
-                "path": file_path,
-                "lastModification": get_current_date()
+                "path": prefix_to + doc['path'][len(prefix_from):],
+                "lastModification": date
             })
+            docs.append(doc)
+            if doc['docType'] == 'File':
+                moves.append(
+                    (doc['_id'], path_from,
+                     _encode(doc['path'] + '/' + doc['name'])))
+
+        errors = self._save_with_parents(docs, parent_folders)
+        if errors:
+            logger.error('Cannot move %s documents of %s' % (
+                len(errors), pathfrom))
+            # Only files that were moved have their content moved.
+            for (doc_id, path_from, path_to) in moves:
+                if doc_id not in errors:
+                    self._move_pending(path_from, path_to, root)
+            return -errno.EIO
+        self._move_pending(pathfrom, pathto, root)
+        return 0
 
-            # Rename all subfiles
-            for res in self.db.view("file/byFolder", key=pathfrom):
-                child_pathfrom = os.path.join(
-                    res.value['path'],
-                    res.value['name'])
-                child_pathto = os.path.join(file_path, name, res.value['name'])
-                self.rename(child_pathfrom, child_pathto, False)
-
-            for res in self.db.view("folder/byFolder", key=pathfrom):
-                child_pathfrom = os.path.join(
-                    res.value['path'],
-                    res.value['name'])
-                child_pathto = os.path.join(file_path, name, res.value['name'])
-                self.rename(child_pathfrom, child_pathto, False)
-
-            if root:
-                self._update_parent_folder(file_path)
-                # Change lastModification for file_path_from in case of file
-                # was moved
-                (file_path_from, name) = _path_split(pathfrom)
-                self._update_parent_folder(file_path_from)
-
-            self.db.save(doc)
-            return 0
+    def _move_pending(self, pathfrom, pathto, root=True):
+        """
+        Move state kept by path for file (or folder) *pathfrom* to *pathto*,
+        once its documents are moved in the database: working copies, open
+        counts, read positions and content not saved yet. Content committed
+        meanwhile under the old path is committed again.
+        """
+        with self.lock:
+            replaced = _move_paths(self.writeBuffers, pathfrom, pathto)
+            _move_paths(self.openFiles, pathfrom, pathto)
+        # Working copies of files overwritten by the rename are dropped.
+        for write_buffer in replaced:
+            write_buffer.close()
+            self._release_base(write_buffer.base)
+        self.readahead.move(pathfrom, pathto)
+        if root and self.journal is not None:
+            self.journal.move(pathfrom, pathto)
 
     def fsync(self, path, isfsyncfile):
         """ TODO: look if something should be done there. """
@@ -485,6 +635,148 @@ class CouchFSDocument(fuse.Fuse):
             doc_ids=ids
         )
 
+    def _get_pending_content(self, path):
+        '''
+        Return content of given file that is not saved to the database yet:
+        its working copy if the file is being modified, or its journal entry
+        in write-back mode. Return None if the content stored in the database
+        is up to date.
+        '''
+        path = _normalize_path(path)
+        with self.lock:
+            if path in self.writeBuffers:
+                return self.writeBuffers[path]
+        if self.journal is not None:
+            return self.journal.get(path)
+        return None
+
+    def _get_write_buffer(self, path):
+        '''
+        Return working copy of given file, create it from current content
+        of the file if needed.
+        '''
+        path = _normalize_path(path)
+        with self.lock:
+            if path in self.writeBuffers:
+                return self.writeBuffers[path]
+        base = None
+        if self.journal is not None:
+            # The entry is committed and removed in the background, it is
+            # kept on disk until the working copy is closed.
+            base = self.journal.pin(path)
+        if base is None:
+            binary = self.cache.get_binary(path)
+            if binary:
+                base = binarycache.BinaryContent(
+                    self.binary_cache, binary['id'], binary.get('rev'))
+        with self.lock:
+            # Another thread may have created it meanwhile.
+            if path not in self.writeBuffers:
+                self.writeBuffers[path] = writebuffer.WriteBuffer(
+                    self.buffer_folder, base,
+                    block_size=self.binary_cache.block_size)
+                return self.writeBuffers[path]
+            write_buffer = self.writeBuffers[path]
+        self._release_base(base)
+        return write_buffer
+
+    def _release_base(self, base):
+        '''
+        Release the base content of a working copy that is closed.
+        '''
+        if isinstance(base, journal.JournalEntry):
+            self.journal.unpin(base)
+
+    def _save_write_buffer(self, path):
+        '''
+        Save working copy of given file, to the journal in write-back mode,
+        else to the database.
+        '''
+        with self.lock:
+            write_buffer = self.writeBuffers.pop(path, None)
+        if write_buffer is None:
+            return
+        try:
+            if self.journal is not None:
+                self.journal.add(path, write_buffer, get_current_date())
+            else:
+                self._save_file(path, write_buffer, get_current_date())
+        finally:
+            write_buffer.close()
+            self._release_base(write_buffer.base)
+
+    def _save_file(self, path, content, date):
+        '''
+        Save *content* (a write buffer or a journal entry) as the new content
+        of file located at *path*.
+            date {string}: last modification date of the file.
+        '''
+        file_doc = dbutils.get_file(self.db, path)
+        if file_doc is None:
+            # File may be renamed meanwhile: the journal commits it again
+            # under its new path, unless it was removed.
+            raise IOError(errno.ENOENT,
+                          'Cannot save file %s, no entry found' % path)
+
+        binary = file_doc.get('binary', {}).get('file')
+        if binary is not None:
+            try:
+                binary['rev'] = self._save_binary(
+                    binary['id'], binary.get('rev'), content)
+            except ResourceNotFound:
+                logger.warn('Binary %s of file %s not found, creating a new '
+                            'one' % (binary['id'], path))
+                binary = self._create_binary(content)
+                file_doc['binary'] = {'file': binary}
+        elif content.size > 0:
+            binary = self._create_binary(content)
+            file_doc['binary'] = {'file': binary}
+        file_doc['size'] = content.size
+        file_doc['lastModification'] = date
+        self.db.save(file_doc)
+        self.cache.update_document(file_doc)
+        if binary is not None:
+            # Uploaded content is the one of the new binary revision.
+            self.binary_cache.add(binary['id'], binary['rev'], content)
+
+    def _create_binary(self, content):
+        '''
+        Create a binary holding *content*, the first content of a file.
+        Small contents are sent with the binary document, so the binary is
+        created with a single revision. Return id and revision of the
+        binary.
+        '''
+        binary = {"_id": dbutils.get_new_id(), "docType": "Binary"}
+        if content.size <= INLINE_BINARY_SIZE:
+            binary["_attachments"] = {
+                "file": {
+                    "content_type": "application/octet-stream",
+                    "data": base64.b64encode(
+                        content.stream().read(content.size))
+                }
+            }
+            dbutils.create_docs(self.db, [binary])
+        else:
+            self.db.save(binary)
+            self.db.put_attachment(binary, content.stream(), filename="file")
+        return {"id": binary["_id"], "rev": binary["_rev"]}
+
+    def _save_binary(self, binary_id, rev, content):
+        '''
+        Upload *content* as attachment of given binary. Data are streamed
+        from the content file (chunked transfer). Return the new revision of
+        the binary, as given by the upload response.
+            rev {string}: revision of the binary known by the file document.
+        '''
+        binary = {'_id': binary_id, '_rev': rev}
+        try:
+            self.db.put_attachment(binary, content.stream(), filename="file")
+        except ResourceConflict:
+            # File document was not up to date with its binary.
+            binary = self.db[binary_id]
+            self.db.put_attachment(binary, content.stream(), filename="file")
+        return binary['_rev']
+
     def _update_parent_folder(self, parent_folder):
         """
         Update parent folder
@@ -494,10 +786,71 @@ class CouchFSDocument(fuse.Fuse):
         date of parent folder should be updated
 
         """
-        folder = dbutils.get_folder(self.db, parent_folder)
-        if folder is not None:
-            folder['lastModification'] = get_current_date()
-            self.db.save(folder)
+        self._save_with_parents([], [parent_folder])
+
+    def _save_with_parents(self, docs, parent_folders):
+        """
+        Save *docs* in bulk and update last modification date of given
+        parent folders. Dates change in the tree right away, they are saved
+        to the database later, together with other changes of the same
+        folders. Return errors of documents that could not be saved, by id.
+            docs {list}: documents to save
+            parent_folders {list}: parent folder paths
+        """
+        errors = {}
+        if docs:
+            errors = dbutils.save_docs(self.db, docs)
+            for doc in docs:
+                if doc.get('_id') not in errors:
+                    self.cache.update_document(doc)
+
+        date = get_current_date()
+        for path in parent_folders:
+            # Paths come from FUSE (UTF-8) or from documents (unicode),
+            # dates are kept by UTF-8 path.
+            path = _encode(_normalize_path(path))
+            if path != '':
+                self.folder_dates.set(path, date)
+                self.cache.set_mtime(path, date)
+        return errors
+
+    def _save_folder_dates(self, dates):
+        """
+        Save last modification dates of folders, with a request to get the
+        folders and a bulk save. Return paths of folders that could not be
+        saved, to save them again later. Folders that do not exist anymore
+        are skipped.
+            dates {dict}: dates by folder path (UTF-8)
+        """
+        paths = {}
+        for path in dates:
+            try:
+                paths[path.decode('utf-8')] = path
+            except UnicodeDecodeError:
+                logger.error('Cannot save date of folder %r, path is not '
+                             'UTF-8' % path)
+
+        rows = self.db.view("folder/byFullPath", keys=paths.keys(),
+                            include_docs=True)
+        folders = []
+        for row in rows:
+            path = paths.get(row.key)
+            if path is None or row.doc is None:
+                continue
+            folder = row.doc
+            folder['lastModification'] = dates[path]
+            folders.append((path, folder))
+
+        errors = dbutils.save_docs(
+            self.db, [folder for (path, folder) in folders])
+        failed = []
+        for (path, folder) in folders:
+            if folder['_id'] in errors:
+                logger.warn('Cannot save date of folder %s' % path)
+                failed.append(path)
+            else:
+                self.cache.update_document(folder)
+        return failed
 
 
 def _normalize_path(path):
@@ -514,6 +867,29 @@ def _normalize_path(path):
         return '/' + path
 
 
+def _move_paths(items, pathfrom, pathto):
+    '''
+    Move items of a dict by path from file (or folder) *pathfrom* to
+    *pathto*. Return items replaced by the moved ones.
+    '''
+    moved = {}
+    for path in items.keys():
+        if path == pathfrom or path.startswith(pathfrom + '/'):
+            moved[pathto + path[len(pathfrom):]] = items.pop(path)
+    replaced = [items[path] for path in moved if path in items]
+    items.update(moved)
+    return replaced
+
+
+def _encode(text):
+    '''
+    Encode text from the database to UTF-8, like paths given by FUSE.
+    '''
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
 def _path_split(path):
     '''
     Split folder path and file name.
@@ -539,11 +915,18 @@ def unmount(path):
     logger.info('Folder %s unmounted' % path)
 
 
-def mount(name, path):
+def mount(name, path, cache_size=None, block_size=None,
+          readahead_window=None, write_back=False, multithreaded=False,
+          attr_timeout=None):
     '''
-    Mount given folder corresponding to given device.
+    Mount given folder corresponding to given device. If *multithreaded* is
+    True, FUSE operations are handled concurrently.
     '''
     logger.info('Attempt to mount %s' % path)
-    fs = CouchFSDocument(name, path, 'http://localhost:5984/%s' % name)
-    fs.multithreaded = 0
+    fs = CouchFSDocument(name, path, 'http://localhost:5984/%s' % name,
+                         cache_size=cache_size, block_size=block_size,
+                         readahead_window=readahead_window,
+                         write_back=write_back,
+                         attr_timeout=attr_timeout)
+    fs.multithreaded = multithreaded
     fs.main()
@@ -1,21 +1,123 @@
+import os
 import json
+import uuid
 import string
 import random
 import requests
 import logging
+import threading
 
 import local_config
 
 
-from couchdb import Server
+from couchdb import Server, http, util
 from couchdb.http import PreconditionFailed, ResourceConflict
 
 logger = logging.getLogger(__name__)
 local_config.configure_logger(logger)
 
+# Number of rows fetched per request when iterating over a whole view.
+VIEW_BATCH_SIZE = 1000
+# Local document holding the database identifier (see get_db_uuid()).
+DB_UUID_ID = '_local/cozyfuse'
+
+
+COUCHDB_URL = 'http://localhost:5984/'
+# Maximum number of idle connections kept open to CouchDB, per device.
+POOL_SIZE = 8
+
+# Servers and databases shared by all threads of the process, by device
+# name (None for the server without credentials).
+_connections = {}
+_connections_lock = threading.Lock()
+_connections_pid = None
+
+
+class ConnectionPool(http.ConnectionPool):
+    '''
+    Pool of keep-alive connections, safe to use from several threads. At
+    most *size* idle connections are kept per host, extra connections are
+    closed when they are released.
+    '''
+
+    def __init__(self, timeout=None, size=POOL_SIZE):
+        http.ConnectionPool.__init__(self, timeout)
+        self.size = size
+
+    def release(self, url, conn):
+        (scheme, host) = util.urlsplit(url, 'http', False)[:2]
+        with self.lock:
+            conns = self.conns.setdefault((scheme, host), [])
+            if len(conns) < self.size:
+                conns.append(conn)
+                return
+        conn.close()
+
+
+def get_server(database=None):
+    '''
+    Return CouchDB server with credentials of given *database*, or without
+    credentials if *database* is None. Servers are created once per
+    process: their session keeps connections open and credentials are read
+    from the configuration only the first time.
+    '''
+    return _get_connection(database)[0]
+
+
+def _get_connection(database):
+    '''
+    Return (server, databases) of given device, databases being a dict of
+    databases already opened with this server.
+    '''
+    global _connections_pid
+    with _connections_lock:
+        # Connections opened before a fork (daemon mode) belong to the
+        # parent process.
+        if _connections_pid != os.getpid():
+            _connections.clear()
+            _connections_pid = os.getpid()
+        connection = _connections.get(database)
+        if connection is None:
+            session = http.Session()
+            session.connection_pool = ConnectionPool()
+            server = Server(COUCHDB_URL, session=session)
+            if database is not None:
+                server.resource.credentials = \
+                    local_config.get_db_credentials(database)
+            connection = (server, {})
+            _connections[database] = connection
+        return connection
+
+
+def _open_db(database, credentials=True):
+    '''
+    Return given database, opened with the shared server. Existence of the
+    database is checked only the first time.
+    '''
+    if credentials:
+        (server, databases) = _get_connection(database)
+    else:
+        (server, databases) = _get_connection(None)
+    db = databases.get(database)
+    if db is None:
+        db = server[database]
+        databases[database] = db
+    return (db, server)
+
+
+def _forget_db(database):
+    '''
+    Drop shared server and database of given device, after the database
+    was removed.
+    '''
+    with _connections_lock:
+        _connections.pop(database, None)
+        for (server, databases) in _connections.values():
+            databases.pop(database, None)
+
 
 def create_db(database):
-    server = Server('http://localhost:5984/')
+    server = get_server()
     try:
         db = server.create(database)
         logger.info('[DB] Database %s created' % database)
@@ -30,11 +132,7 @@ def get_db(database, credentials=True):
     Get or create given database from/in CouchDB.
     '''
     try:
-        server = Server('http://localhost:5984/')
-        if credentials:
-            server.resource.credentials = \
-                local_config.get_db_credentials(database)
-        return server[database]
+        return _open_db(database, credentials)[0]
     except Exception:
         logging.exception('[DB] Cannot connect to the database')
 
@@ -45,15 +143,32 @@ def get_db_and_server(database):
     Get or create given database from/in CouchDB.
     '''
     try:
-        server = Server('http://localhost:5984/')
-        server.resource.credentials = local_config.get_db_credentials(database)
-        db = server[database]
-        return (db, server)
+        return _open_db(database)
     except Exception:
         logging.exception('[DB] Cannot connect to the database %s' % database)
         return (None, None)
 
 
+class Databases():
+    '''
+    Database and server of a device. They are shared by all threads: the
+    session pools connections, so concurrent requests use distinct
+    connections. They are looked up at each access, so a process forked
+    after this object was created opens its own connections.
+    '''
+
+    def __init__(self, database):
+        self.database = database
+
+    @property
+    def db(self):
+        return get_db_and_server(self.database)[0]
+
+    @property
+    def server(self):
+        return get_db_and_server(self.database)[1]
+
+
 def init_db(database):
     '''
     Create all required views to make Cozy FUSE working properly.
@@ -70,8 +185,9 @@ def remove_db(database):
     '''
     Destroy given database.
     '''
-    server = Server('http://localhost:5984/')
+    server = get_server()
     server.delete(database)
+    _forget_db(database)
     logger.info('[DB] Local database %s removed' % database)
 
 
@@ -87,18 +203,170 @@ def get_device(name):
 
 
 def get_folders(db):
-    return db.view("folder/all")
+    return db.view("folder/all", include_docs=True)
 
 
 def get_files(db):
-    return db.view("file/all")
+    return db.view("file/all", include_docs=True)
+
+
+def iter_view(db, name, batch_size=VIEW_BATCH_SIZE, **options):
+    '''
+    Iterate over rows of given view. Rows are fetched *batch_size* at a time,
+    so large views are neither loaded in a single response nor queried once
+    per row.
+    '''
+    options['limit'] = batch_size + 1
+    while True:
+        rows = list(db.view(name, **options))
+        for row in rows[:batch_size]:
+            yield row
+        if len(rows) <= batch_size:
+            break
+        # Extra row is the first one of the next batch.
+        options['startkey'] = rows[-1].key
+        options['startkey_docid'] = rows[-1].id
+
+
+def get_docs(db, ids):
+    '''
+    Return documents of given *ids* in a dict, by id. Missing and deleted
+    documents are left out. Documents are fetched with one request per
+    VIEW_BATCH_SIZE ids.
+    '''
+    docs = {}
+    for batch in _get_batches(list(ids)):
+        for row in db.view('_all_docs', keys=batch, include_docs=True):
+            if row.doc is not None:
+                docs[row.id] = row.doc
+    return docs
+
+
+def get_revs(db, ids):
+    '''
+    Return current revision of given documents in a dict, by id, without
+    fetching their content. Missing and deleted documents are left out.
+    '''
+    revs = {}
+    for batch in _get_batches(list(ids)):
+        for row in db.view('_all_docs', keys=batch):
+            if row.value is not None and not row.value.get('deleted'):
+                revs[row.id] = row.value['rev']
+    return revs
+
+
+def save_docs(db, docs):
+    '''
+    Save given documents with one request per VIEW_BATCH_SIZE documents.
+    Saved documents are updated with their id and new revision. Return
+    errors (ResourceConflict most of the time) of documents that could not
+    be saved, by document id.
+    '''
+    errors = {}
+    for batch in _get_batches(list(docs)):
+        for (success, doc_id, result) in db.update(batch):
+            if not success:
+                errors[doc_id] = result
+    if errors:
+        logger.warn('[DB] %s documents not saved: %s' % (
+            len(errors), ', '.join(errors)))
+    return errors
+
+
+def delete_docs(db, docs):
+    '''
+    Delete given documents, which must have an id and a revision, with one
+    request per VIEW_BATCH_SIZE documents. Return errors by document id,
+    like save_docs().
+    '''
+    return save_docs(db, [{'_id': doc['_id'], '_rev': doc['_rev'],
+                           '_deleted': True} for doc in docs])
+
+
+def delete_docs_by_id(db, ids):
+    '''
+    Delete documents of given *ids* at their current revision. Missing
+    documents are ignored. Return errors by document id.
+    '''
+    revs = get_revs(db, ids)
+    return delete_docs(db, [{'_id': doc_id, '_rev': rev}
+                            for (doc_id, rev) in revs.iteritems()])
+
+
+def get_orphan_binaries(db):
+    '''
+    Return ids of the binaries no file refers to.
+    '''
+    binaries = set(row.id for row in iter_view(db, 'binary/all'))
+    for row in iter_view(db, 'file/all', include_docs=True):
+        binary = row.doc.get('binary', {}).get('file')
+        if binary is not None:
+            binaries.discard(binary['id'])
+    return binaries
+
+
+def create_docs(db, docs):
+    '''
+    Create new documents with a single request. Documents must have an id.
+    Their first revision is generated by the client (see get_first_rev()),
+    so documents created together can refer to each other's revision (a
+    file and its binary for instance).
+    '''
+    for doc in docs:
+        if '_rev' not in doc:
+            doc['_rev'] = get_first_rev()
+    for (success, doc_id, error) in db.update(docs, new_edits=False):
+        if not success:
+            raise error
+
+
+def get_new_id():
+    '''
+    Return a new document id, generated without asking the database.
+    '''
+    return uuid.uuid4().hex
+
+
+def get_first_rev():
+    '''
+    Return a revision for a new document, generated without asking the
+    database.
+    '''
+    return '1-%s' % uuid.uuid4().hex
+
+
+def get_db_uuid(db):
+    '''
+    Return an identifier of the database, stored in a local document the
+    first time it is asked for. Unlike the database name, it changes when
+    the database is deleted and created again: local documents are
+    neither kept nor replicated.
+    '''
+    doc = db.get(DB_UUID_ID)
+    if doc is None:
+        doc = {'_id': DB_UUID_ID, 'uuid': get_new_id()}
+        try:
+            db.save(doc)
+        except ResourceConflict:
+            # Created by another process meanwhile.
+            doc = db[DB_UUID_ID]
+    return doc['uuid']
+
+
+def _get_batches(items):
+    '''
+    Split *items* in lists of VIEW_BATCH_SIZE items at most.
+    '''
+    return [items[start:start + VIEW_BATCH_SIZE]
+            for start in range(0, len(items), VIEW_BATCH_SIZE)]
 
 
 def get_folder(db, path):
     if len(path) > 0 and path[0] != '/':
         path = '/' + path
     try:
-        folder = list(db.view("folder/byFullPath", key=path))[0].value
+        folder = list(db.view("folder/byFullPath", key=path,
+                              include_docs=True))[0].doc
     except IndexError:
         folder = None
     return folder
@@ -108,12 +376,40 @@ def get_file(db, path):
     if len(path) > 0 and path[0] != '/':
         path = '/' + path
     try:
-        file_doc = list(db.view("file/byFullPath", key=path))[0].value
+        file_doc = list(db.view("file/byFullPath", key=path,
+                                include_docs=True))[0].doc
     except IndexError:
         file_doc = None
     return file_doc
 
 
+def get_descendants(db, path):
+    '''
+    Return folders and files located under folder *path*, at any depth.
+    Folders come first. Documents are found with a range query on the
+    components of their path, so the number of requests does not depend on
+    the number of sub-folders.
+    '''
+    components = _get_path_components(path)
+    docs = []
+    for doc_type in ('folder', 'file'):
+        rows = iter_view(db, '%s/byPathComponents' % doc_type,
+                         startkey=components, endkey=components + [{}],
+                         include_docs=True)
+        docs.extend(row.doc for row in rows)
+    return docs
+
+
+def _get_path_components(path):
+    '''
+    Return names of the folders of *path*, as emitted by byPathComponents
+    views.
+    '''
+    if isinstance(path, str):
+        path = path.decode('utf-8')
+    return [name for name in path.split('/') if name != '']
+
+
 def get_random_key():
     '''
     Generate a random key of 20 chars. The first character is not a number
@@ -177,33 +473,60 @@ def remove_db_user(database):
 
 def init_database_view(docType, db):
     '''
-    Add view in database for given docType.
+    Add view in database for given docType. Views of an existing design
+    document are replaced if they differ, otherwise ResourceConflict is
+    raised.
+
+    Views emit no value, documents are fetched with include_docs when
+    needed: indexes stay small and are quickly rebuilt.
     '''
-    db["_design/%s" % docType.lower()] = {
+    _save_design(db, "_design/%s" % docType.lower(), {
         "views": {
             "all": {
                 "map": """function (doc) {
                               if (doc.docType === \"%s\") {
-                                  emit(doc._id, doc)
+                                  emit(doc._id, null)
                               }
                            }""" % docType
             },
             "byFolder": {
                 "map": """function (doc) {
                               if (doc.docType === \"%s\") {
-                                  emit(doc.path, doc)
+                                  emit(doc.path, null)
                               }
                           }""" % docType
             },
             "byFullPath": {
                 "map": """function (doc) {
                   if (doc.docType === \"%s\") {
-                      emit(doc.path + '/' + doc.name, doc);
+                      emit(doc.path + '/' + doc.name, null);
+                    }
+                  }""" % docType
+            },
+            "byPathComponents": {
+                "map": """function (doc) {
+                  if (doc.docType === \"%s\") {
+                      var names = (doc.path || '').split('/');
+                      emit(names.filter(function (name) {
+                          return name !== '';
+                      }), null);
                     }
                   }""" % docType
             }
         }
-    }
+    })
+
+
+def _save_design(db, design_id, design):
+    '''
+    Create design document. If it exists with other views (database was
+    initialized by a previous version), they are replaced, otherwise
+    ResourceConflict is raised.
+    '''
+    current = db.get(design_id)
+    if current is not None and current.get("views") != design["views"]:
+        design["_rev"] = current["_rev"]
+    db[design_id] = design
 
 
 def init_database_views(database):
@@ -250,17 +573,17 @@ def init_database_views(database):
         logger.warn('[DB] Device design document already exists')
 
     try:
-        db["_design/binary"] = {
+        _save_design(db, "_design/binary", {
             "views": {
                 "all": {
                     "map": """function (doc) {
                                   if (doc.docType === \"Binary\") {
-                                      emit(doc._id, doc)
+                                      emit(doc._id, null)
                                   }
                                }"""
                 }
             }
-        }
+        })
         logger.info('[DB] Binary design document created')
     except ResourceConflict:
         logger.warn('[DB] Binary design document already exists')
@@ -0,0 +1,112 @@
+import time
+import logging
+import threading
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+# Delay (in seconds) during which folder changes are gathered before they
+# are saved.
+FLUSH_DELAY = 2
+
+
+class FolderDates():
+    '''
+    Last modification dates of folders, waiting to be saved to the
+    database.
+
+    Creating, removing or renaming a file changes the date of its folder.
+    Dates are kept in memory and a background flusher saves them with
+    *save* every *delay* seconds, while there are changes. Each folder is
+    saved once per flush, whatever the number of changes made meanwhile.
+
+    *save* is called with a dict of dates by folder path. It returns the
+    paths of the folders that could not be saved, they are saved at next
+    flush. It should raise an exception when all of them should be saved
+    again.
+    '''
+
+    def __init__(self, save, delay=FLUSH_DELAY):
+        self.save = save
+        self.delay = delay
+        self.condition = threading.Condition()
+        # path -> date waiting to be saved.
+        self.pending = {}
+        self.thread = None
+
+    def set(self, path, date):
+        '''
+        Set last modification date of folder located at *path*.
+        '''
+        with self.condition:
+            self.pending[path] = date
+            self.condition.notify()
+
+    def get(self, path):
+        '''
+        Return date of given folder not saved yet, or None.
+        '''
+        with self.condition:
+            return self.pending.get(path)
+
+    def move(self, pathfrom, pathto):
+        '''
+        Update pending dates after folder *pathfrom* has been renamed to
+        *pathto*.
+        '''
+        with self.condition:
+            for path in self.pending.keys():
+                if path == pathfrom or path.startswith(pathfrom + '/'):
+                    date = self.pending.pop(path)
+                    self.pending[pathto + path[len(pathfrom):]] = date
+
+    def discard(self, path):
+        '''
+        Drop dates of given folder and its subfolders, once it has been
+        removed.
+        '''
+        with self.condition:
+            for pending_path in self.pending.keys():
+                if pending_path == path or \
+                        pending_path.startswith(path + '/'):
+                    del self.pending[pending_path]
+
+    def flush(self):
+        '''
+        Save all pending dates now.
+        '''
+        with self.condition:
+            dates = self.pending
+            self.pending = {}
+        if not dates:
+            return
+
+        try:
+            failed = self.save(dates)
+        except Exception:
+            logger.exception('Cannot save dates of %s folders' % len(dates))
+            failed = dates.keys()
+
+        with self.condition:
+            for path in failed:
+                # A newer date may have been set meanwhile.
+                self.pending.setdefault(path, dates[path])
+
+    def start(self):
+        '''
+        Start the flusher thread.
+        '''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+            time.sleep(self.delay)
+            self.flush()
@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+# Delay (in seconds) before retrying a failed commit.
+RETRY_DELAY = 5
+
+
+class JournalEntry():
+    '''
+    File content waiting to be saved to the database. Content is stored in
+    <seq>.data and metadata (file path, size and modification date) in
+    <seq>.json.
+    '''
+
+    def __init__(self, folder, seq, path, size, date):
+        self.folder = folder
+        self.seq = seq
+        self.path = path
+        self.size = size
+        self.date = date
+        self.data_path = os.path.join(folder, '%020d.data' % seq)
+        self.file = None
+        # Time before which a failed commit is not retried.
+        self.retry_at = 0
+        # Number of working copies reading this content, the data file is
+        # kept until they are closed.
+        self.users = 0
+        self.removed = False
+        # Set when the file is removed while the entry is committed.
+        self.discarded = False
+
+    def save(self):
+        '''
+        Write metadata file. It is written to a temporary file first, so an
+        entry is either complete or absent after a crash.
+        '''
+        meta_path = os.path.join(self.folder, '%020d.json' % self.seq)
+        with open(meta_path + '.tmp', 'w') as meta:
+            json.dump({
+                'path': self.path,
+                'size': self.size,
+                'date': self.date
+            }, meta)
+            meta.flush()
+            os.fsync(meta.fileno())
+        os.rename(meta_path + '.tmp', meta_path)
+
+    def stream(self):
+        '''
+        Return a file object to read the content from the start.
+        '''
+        if self.file is None:
+            self.file = open(self.data_path, 'rb')
+        self.file.seek(0)
+        return self.file
+
+    def get_size(self):
+        return self.size
+
+    def read(self, size, offset):
+        with open(self.data_path, 'rb') as data:
+            data.seek(offset)
+            return data.read(size)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        '''
+        Remove entry files. The data file is kept while the entry is used
+        as the base of a working copy.
+        '''
+        self.close()
+        self.removed = True
+        _remove_file(os.path.join(self.folder, '%020d.json' % self.seq))
+        if not self.users:
+            _remove_file(self.data_path)
+
+    def pin(self):
+        self.users += 1
+
+    def unpin(self):
+        self.users -= 1
+        if not self.users and self.removed:
+            _remove_file(self.data_path)
+
+    @classmethod
+    def load(cls, folder, seq):
+        '''
+        Read entry from its metadata file. Return None if the entry is
+        incomplete.
+        '''
+        entry = cls(folder, seq, None, None, None)
+        try:
+            with open(os.path.join(folder, '%020d.json' % seq)) as meta:
+                data = json.load(meta)
+        except (IOError, ValueError):
+            return None
+        if not os.path.isfile(entry.data_path):
+            return None
+        entry.path = data['path']
+        entry.size = data['size']
+        entry.date = data['date']
+        return entry
+
+
+class Journal():
+    '''
+    Write-back journal, stored in ~/.cozyfuse/<device>/journal.
+
+    Closed files are added to the journal instead of being saved to the
+    database right away. A background committer saves them in order with
+    the *commit* function. When a file is saved again before its previous
+    content is committed, only the latest content is kept. Entries left by
+    a previous mount are committed when the journal is started.
+
+    *commit* is called with the file path, the entry (which provides size
+    and stream()) and the file modification date. It should raise an
+    exception when saving should be retried later.
+    '''
+
+    def __init__(self, folder, commit):
+        self.folder = folder
+        self.commit = commit
+        self.condition = threading.Condition()
+        # path -> entry waiting to be committed, oldest first.
+        self.pending = OrderedDict()
+        self.committing = None
+        self.seq = 0
+        self.thread = None
+
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        self._load_entries()
+
+    def add(self, path, write_buffer, date):
+        '''
+        Add content of *write_buffer* to the journal, as the new content of
+        file located at *path*.
+        '''
+        with self.condition:
+            self.seq += 1
+            entry = JournalEntry(
+                self.folder, self.seq, path, write_buffer.size, date)
+        write_buffer.save(entry.data_path)
+        entry.save()
+
+        with self.condition:
+            previous = self.pending.pop(path, None)
+            if previous is not None:
+                previous.remove()
+            self.pending[path] = entry
+            self.condition.notify()
+        logger.info('File %s added to journal' % path)
+
+    def get(self, path):
+        '''
+        Return the latest entry not committed yet for given path, or None.
+        '''
+        with self.condition:
+            entry = self.pending.get(path)
+            if entry is None and self.committing is not None \
+                    and self.committing.path == path:
+                entry = self.committing
+            return entry
+
+    def pin(self, path):
+        '''
+        Return the same entry as get(), kept readable until unpin() is
+        called, even if it is committed or replaced meanwhile.
+        '''
+        with self.condition:
+            entry = self.get(path)
+            if entry is not None:
+                entry.pin()
+            return entry
+
+    def unpin(self, entry):
+        with self.condition:
+            entry.unpin()
+
+    def move(self, pathfrom, pathto):
+        '''
+        Update entries after file (or folder) *pathfrom* has been renamed
+        to *pathto*.
+        '''
+        with self.condition:
+            entries = self.pending.values()
+            if self.committing is not None:
+                entries.append(self.committing)
+            for entry in entries:
+                if entry.path == pathfrom or \
+                        entry.path.startswith(pathfrom + '/'):
+                    old_path = entry.path
+                    entry.path = pathto + entry.path[len(pathfrom):]
+                    entry.save()
+                    if self.pending.get(old_path) is entry:
+                        del self.pending[old_path]
+                        self.pending[entry.path] = entry
+
+    def discard(self, path):
+        '''
+        Drop entry of given path, once the file has been removed.
+        '''
+        with self.condition:
+            entry = self.pending.pop(path, None)
+            if entry is not None:
+                entry.remove()
+            if self.committing is not None and self.committing.path == path:
+                self.committing.discarded = True
+
+    def start(self):
+        '''
+        Start the committer thread.
+        '''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        '''
+        Commit entries, oldest first. An entry that cannot be committed is
+        retried after RETRY_DELAY, behind the other entries, so it does not
+        hold them back.
+        '''
+        while True:
+            with self.condition:
+                entry = self._pop_entry()
+                self.committing = entry
+
+            try:
+                self.commit(entry.path, entry, entry.date)
+                failed = False
+            except Exception:
+                logger.exception('Commit failed for %s' % entry.path)
+                failed = True
+
+            with self.condition:
+                # A newer content is committed instead when there is one.
+                if failed and not entry.discarded \
+                        and entry.path not in self.pending:
+                    entry.retry_at = time.time() + RETRY_DELAY
+                    self.pending[entry.path] = entry
+                else:
+                    entry.remove()
+                self.committing = None
+
+    def _pop_entry(self):
+        '''
+        Wait for an entry to commit and remove it from pending entries.
+        Must be called with the condition held.
+        '''
+        while True:
+            now = time.time()
+            retry_at = None
+            for entry in self.pending.values():
+                if entry.retry_at <= now:
+                    del self.pending[entry.path]
+                    return entry
+                if retry_at is None or entry.retry_at < retry_at:
+                    retry_at = entry.retry_at
+
+            if retry_at is None:
+                self.condition.wait()
+            else:
+                self.condition.wait(retry_at - now)
+
+    def _load_entries(self):
+        '''
+        Load entries left by a previous mount, in order.
+        '''
+        seqs = []
+        for name in os.listdir(self.folder):
+            (seq, extension) = os.path.splitext(name)
+            if extension == '.json':
+                seqs.append(int(seq))
+            elif extension == '.tmp':
+                os.remove(os.path.join(self.folder, name))
+
+        for seq in sorted(seqs):
+            entry = JournalEntry.load(self.folder, seq)
+            if entry is None:
+                JournalEntry(self.folder, seq, None, None, None).remove()
+                continue
+            previous = self.pending.pop(entry.path, None)
+            if previous is not None:
+                previous.remove()
+            self.pending[entry.path] = entry
+            self.seq = seq
+
+        # Data files without metadata come from an interrupted add.
+        for name in os.listdir(self.folder):
+            (seq, extension) = os.path.splitext(name)
+            if extension == '.data' and int(seq) not in seqs:
+                os.remove(os.path.join(self.folder, name))
+
+        if self.pending:
+            logger.info('%s files left in journal' % len(self.pending))
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
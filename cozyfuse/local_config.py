@@ -1,4 +1,5 @@
 import os
+import shutil
 import daemon
 import lockfile
 import logging
@@ -62,17 +63,19 @@ def add_config(name, url, path, db_login, db_password):
 
 def remove_config(name):
     '''
-    Add to the config file (~/.cozyfuse/config.yaml) device named *name* with
-    *url* and *path* as parameters.
+    Remove device named *name* from the config file
+    (~/.cozyfuse/config.yaml), and its folder (~/.cozyfuse/<name>).
     '''
     config = get_full_config()
     config.pop(name, None)
     output_file = file(CONFIG_PATH, 'w')
     dump(config, output_file, default_flow_style=False)
 
+    # Device folder holds the binary cache, write buffers, journal and
+    # tree snapshot.
     folder = os.path.join(CONFIG_FOLDER, name)
     if os.path.isdir(folder):
-        os.rmdir(folder)
+        shutil.rmtree(folder)
     logger.info('[Config] Configuration for %s removed' % name)
 
 
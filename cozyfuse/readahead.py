@@ -0,0 +1,110 @@
+import logging
+import threading
+import Queue
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+# Default number of blocks fetched in advance for sequential reads.
+DEFAULT_WINDOW = 8
+WORKERS = 4
+
+
+class ReadAhead():
+    '''
+    Read-ahead stage in front of the binary cache. When a file is read
+    sequentially (each read starts where the previous one ended), the next
+    blocks of the file are downloaded by a pool of background workers, so
+    they are already cached when the reader reaches them.
+    '''
+
+    def __init__(self, binary_cache, window=DEFAULT_WINDOW, workers=WORKERS):
+        self.binary_cache = binary_cache
+        self.window = window
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+        # path -> (end of last read, last block scheduled for download)
+        self.positions = {}
+
+    def read(self, path, binary_id, rev, size, offset):
+        '''
+        Return *size* bytes of the file located at *path*, starting at
+        *offset*, and schedule download of the next blocks if the file is
+        read sequentially.
+        '''
+        buf = self.binary_cache.read(binary_id, rev, size, offset)
+        if self.window > 0:
+            self._schedule(path, binary_id, rev, size, offset)
+        return buf
+
+    def forget(self, path):
+        '''
+        Drop read state of given path, once the file is closed.
+        '''
+        with self.lock:
+            self.positions.pop(path, None)
+
+    def move(self, pathfrom, pathto):
+        '''
+        Update read state after file (or folder) *pathfrom* has been renamed
+        to *pathto*.
+        '''
+        with self.lock:
+            for path in self.positions.keys():
+                if path == pathfrom or path.startswith(pathfrom + '/'):
+                    position = self.positions.pop(path)
+                    self.positions[pathto + path[len(pathfrom):]] = position
+
+    def _schedule(self, path, binary_id, rev, size, offset):
+        '''
+        Queue download of the blocks following current read if it is
+        sequential. Blocks are scheduled by half windows, so workers are
+        not woken up for every read.
+        '''
+        block_size = self.binary_cache.block_size
+        block = (offset + max(size, 1) - 1) // block_size
+
+        with self.lock:
+            (end, scheduled) = self.positions.get(path, (None, -1))
+            if offset != end and offset != 0:
+                # Random access, nothing to read ahead.
+                self.positions[path] = (offset + size, -1)
+                return
+
+            if scheduled < block + self.window // 2:
+                first = max(scheduled + 1, block + 1)
+                scheduled = block + self.window
+                self._start_workers()
+                for index in range(first, scheduled + 1):
+                    self.queue.put((binary_id, rev, index))
+            self.positions[path] = (offset + size, scheduled)
+
+    def _start_workers(self):
+        '''
+        Start worker threads on first use, so they are created in the
+        mounting process (after FUSE went to background).
+        '''
+        if not self.threads:
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self):
+        '''
+        Download queued blocks.
+        '''
+        while True:
+            (binary_id, rev, block) = self.queue.get()
+            try:
+                self.binary_cache.fetch(binary_id, rev, block, block)
+            except Exception:
+                logger.exception('Read-ahead failed for binary %s' %
+                                 binary_id)
+            finally:
+                self.queue.task_done()
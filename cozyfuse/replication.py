@@ -5,8 +5,6 @@ import logging
 import dbutils
 import local_config
 
-from couchdb import Server
-
 logger = logging.getLogger(__name__)
 local_config.configure_logger(logger)
 
@@ -42,7 +40,7 @@ def replicate(database, url, device, device_password, device_id,
     local = 'http://%s:%s@localhost:5984/%s' % \
             (db_login, db_password, database)
     remote = "https://%s:%s@%s/cozy" % (device, device_password, url[2])
-    server = Server('http://localhost:5984/')
+    server = dbutils.get_server()
 
     if to_local:
         target = local
@@ -126,6 +124,8 @@ class BinaryReplication():
     def replicate_file_changes(self):
         '''
         Replicate all changes related to files and binaries to stored devices.
+        Changes are handled by batches: binaries of a batch are replicated
+        together and the device progression is saved once per batch.
         '''
 
         device = dbutils.get_device(self.db_name)
@@ -134,31 +134,41 @@ class BinaryReplication():
         self.passwordCozy = device['password']
 
         self.ids = {}
-        for res in self.db.view("file/all"):
-            if 'binary' in res.value and 'file' in res.value['binary']:
-                id_binary = res.value['binary']['file']['id']
-                if id_binary in self.db:
-                    binary = self.db[id_binary]
-                    self.ids[res.id] = [id_binary, binary.rev]
-                else:
-                    self.ids[res.id] = [id_binary, ""]
-
-        changes = self.db.changes(feed='continuous',
-                                  heartbeat='1000',
-                                  since=device['change'],
-                                  include_docs=True)
-
-        for line in changes:
-            if not self._is_device(line):
-                device['change'] = line['seq']
-                self.db.save(device)
-
+        binaries = {}
+        for res in dbutils.iter_view(self.db, "file/all", include_docs=True):
+            if 'binary' in res.doc and 'file' in res.doc['binary']:
+                binaries[res.id] = res.doc['binary']['file']['id']
+        revs = dbutils.get_revs(self.db, binaries.values())
+        for (id_doc, id_binary) in binaries.iteritems():
+            self.ids[id_doc] = [id_binary, revs.get(id_binary, "")]
+
+        since = device['change']
+        while True:
+            changes = self.db.changes(feed='longpoll',
+                                      since=since,
+                                      limit=dbutils.VIEW_BATCH_SIZE,
+                                      include_docs=True)
+            since = changes['last_seq']
+            lines = [line for line in changes['results']
+                     if not self._is_device(line)]
+            if not lines:
+                continue
+
+            to_delete = []
+            to_replicate = []
+            for line in lines:
                 if self._is_deleted(line):
-                    self._delete_file(line)
+                    to_delete.extend(self._delete_file(line))
                 elif self._is_new(line):
-                    self._add_file(line)
+                    to_replicate.extend(self._add_file(line))
                 else:
-                    self._update_file(line)
+                    to_replicate.extend(self._update_file(line))
+            self._delete_binaries(to_delete)
+            if to_delete or to_replicate:
+                self._replicate_to_local(to_delete + to_replicate)
+
+            device['change'] = since
+            self.db.save(device)
 
     def _is_device(self, line):
         '''
@@ -185,11 +195,13 @@ class BinaryReplication():
     def _add_file(self, line):
         '''
         If line is a document of which document type is 'File', then the
-        binary document linked to this document is replicated
+        binary document linked to this document is replicated. Return ids
+        of binaries to replicate.
         '''
+        binaries = []
         try:
             id_doc = line['doc']['_id']
-            doc = self.db[id_doc]
+            doc = line['doc']
 
             if 'docType' in doc:
 
@@ -199,7 +211,7 @@ class BinaryReplication():
                     if 'binary' in doc:
                         binary = doc['binary']['file']
                         self.ids[id_doc] = [binary['id'], binary['rev']]
-                        self._replicate_to_local([binary['id']])
+                        binaries.append(binary['id'])
 
                     elif not id_doc in self.ids:
                         self.ids[id_doc] = ["", ""]
@@ -211,43 +223,50 @@ class BinaryReplication():
                 'An error occured while replicating creation for:'
                 'doc %s' % line['doc']['_id']
             )
+        return binaries
 
     def _delete_file(self, line):
         '''
-        Remove binary document if a file has been deleted.
+        Return binary of a file that has been deleted, it has to be removed.
         '''
-        try:
-            id_doc = self.ids.get(line['doc']['_id'])
-
-            if id_doc is not None:
-                binary = self.ids[line['doc']['_id']][0]
+        id_doc = self.ids.pop(line['doc']['_id'], None)
+        if id_doc is not None and id_doc[0]:
+            return [id_doc[0]]
+        return []
 
-                if self.db[binary]:
-                    self.db.delete(self.db[binary])
-                    self._replicate_to_local([binary])
+    def _delete_binaries(self, ids):
+        '''
+        Remove binary documents of deleted files, with a single request.
+        '''
+        try:
+            dbutils.delete_docs_by_id(self.db, ids)
         except Exception:
             logging.exception(
                 'An error occured while replicating deletion for:'
-                'doc %s' % line['doc']['_id']
+                'binaries %s' % ', '.join(ids)
             )
 
     def _update_file(self, line):
         '''
         If a file document has been modified the linked binary is replicated.
+        Return ids of binaries to replicate.
         '''
+        binaries = []
         try:
             id_doc = line['doc']['_id']
-            doc = self.db[id_doc]
+            doc = line['doc']
 
             if 'docType' in doc:
 
                 if doc['docType'] == 'File':
                     logger.info("Updating file %s..." % doc["name"])
-                    binary = doc['binary']['file']
+                    binary = doc.get('binary', {}).get('file')
 
-                    if binary['rev'] != self.ids[id_doc][1]:
+                    # Empty files have no binary.
+                    if binary is not None and \
+                            binary['rev'] != self.ids.get(id_doc, ["", ""])[1]:
                         self.ids[id_doc] = [binary['id'], binary['rev']]
-                        self._replicate_to_local([binary['id']])
+                        binaries.append(binary['id'])
                     logger.info("File updated: %s" % doc["name"])
 
         except Exception:
@@ -255,6 +274,7 @@ class BinaryReplication():
                 'An error occured while replicating update for:'
                 'doc %s' % line['doc']['_id']
             )
+        return binaries
 
     def _replicate_to_local(self, ids):
         '''
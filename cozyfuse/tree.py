@@ -1,15 +1,15 @@
 import os
+import hashlib
 import logging
 import threading
 import dbutils
 import fuse
 import datetime
 import calendar
-from multiprocessing import Process
+import time
+import cPickle
 import local_config
 import stat
-import multiprocessing
-from couchdb import Server
 
 CONFIG_FOLDER = os.path.join(os.path.expanduser('~'), '.cozyfuse')
 HDLR = logging.FileHandler(os.path.join(CONFIG_FOLDER, 'cozyfuse.log'))
@@ -19,20 +19,25 @@ logger = logging.getLogger(__name__)
 logger.addHandler(HDLR)
 logger.setLevel(logging.INFO)
 
-manager = multiprocessing.Manager()
+# Delay (in seconds) before listening to changes again after an error.
+LISTEN_RETRY_DELAY = 5
+# Minimum delay (in seconds) between two snapshots saved by the listener.
+SNAPSHOT_INTERVAL = 60
+# Version of the snapshot format, snapshots of other versions are ignored.
+SNAPSHOT_VERSION = 5
 
-""" tree is a dictionary which stores tree of files/folders
+""" Cache stores the tree of files/folders in memory
  Format :        -C
-            -A -|   
+            -A -|
     root: -|     -D
             -B
 
-    cache[0] = {
-        tree = {'/':['A','B'], 'A':[C, D]}
-        path_id = {'id1': '/A', 'id2': '/B', 'id3': '/A/C', 'id4': '/A/D'}
-        st = {'/A': st, '/B': st} (complete progressively)
-        binaries = {'/A/C': 'id_binary'}(complete progressively)
-    }
+    root = Node(children={'A': Node(id='id1', children={'C': ..., 'D': ...}),
+                          'B': Node(id='id2', children={})})
+    nodes = {'id1': <Node A>, 'id2': <Node B>, 'id3': <Node C>, ...}
+
+    Names and ids are stored as UTF-8 strings, like paths given by FUSE.
+    Full paths are not stored, they are derived from parents when needed.
 
 """
 class CouchStat(fuse.Stat):
@@ -72,77 +77,299 @@ def get_date(ctime):
     return calendar.timegm(date.utctimetuple())
 
 
+FOLDER_MODE = stat.S_IFDIR | 0o775
+FILE_MODE = stat.S_IFREG | 0o664
+# Inode number of the mount point, FUSE expects 1.
+ROOT_INODE = 1
+
+
+def get_inode(key):
+    '''
+    Return a stable inode number for *key* (a document id): the same file
+    keeps its inode across renames, remounts and machines.
+    '''
+    inode = int(hashlib.md5(key).hexdigest()[:15], 16)
+    if inode <= ROOT_INODE:
+        inode += ROOT_INODE + 1
+    return inode
+
+class Node(object):
+    '''
+    File or folder of the tree. Folders have a dict of children by name,
+    files have a binary id and revision. Slots keep each node small: the
+    tree holds one node per document.
+    '''
+    __slots__ = ('id', 'name', 'parent', 'mode', 'size', 'mtime',
+                 'binary_id', 'binary_rev', 'children')
+
+    def __init__(self, id, name, parent, mode):
+        self.id = id
+        self.name = name
+        self.parent = parent
+        self.mode = mode
+        self.size = 4096
+        self.mtime = 0
+        self.binary_id = None
+        self.binary_rev = None
+        if stat.S_ISDIR(mode):
+            self.children = {}
+        else:
+            self.children = None
+
+    def is_folder(self):
+        return self.children is not None
+
+    def get_path(self):
+        '''
+        Return full path of the node, built from its parents.
+        '''
+        names = []
+        node = self
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return '/' + '/'.join(reversed(names))
+
+    def get_inode(self):
+        '''
+        Return inode number of the node, derived from its document id.
+        Folders known only from their path use the path instead.
+        '''
+        if self.parent is None and self.name == '':
+            return ROOT_INODE
+        if self.id is None:
+            return get_inode(self.get_path())
+        return get_inode(self.id)
+
+    def get_st(self):
+        st = CouchStat()
+        st.st_mode = self.mode
+        st.st_ino = self.get_inode()
+        st.st_nlink = 2 if self.is_folder() else 1
+        st.st_size = self.size
+        st.st_atime = self.mtime
+        st.st_ctime = self.mtime
+        st.st_mtime = self.mtime
+        return st
+
+    def update(self, doc):
+        '''
+        Set attributes of the node from its document.
+        '''
+        self.id = _encode(doc['_id'])
+        if not self.is_folder():
+            # TODO: if size is not set, get the binary
+            # and save the information.
+            self.size = doc.get('size', 4096)
+            binary = doc.get('binary', {}).get('file')
+            if binary:
+                self.binary_id = _encode(binary['id'])
+                self.binary_rev = _encode(binary.get('rev'))
+            else:
+                self.binary_id = None
+                self.binary_rev = None
+        if 'lastModification' in doc:
+            try:
+                self.mtime = get_date(doc['lastModification'])
+            except ValueError:
+                logger.warn('Wrong date for %s' % doc['_id'])
+
+
 # API Change
 
 class Cache():
+    '''
+    In-memory index of the files and folders of a device. It is loaded from
+    the database at mount time, then kept up to date by a thread listening
+    to database changes (see start()). Lookups walk the tree from the root,
+    one dict access per path component.
+
+    The tree is saved to ~/.cozyfuse/<device>/tree.snapshot with the last
+    database sequence it reflects. At next mount, the snapshot is loaded
+    and only changes made since that sequence are read from the database,
+    unless the database was recreated meanwhile.
+    '''
 
     def __init__(self, database):
-        self.db = dbutils.get_db(database)
-        # Declare variables
-        # Init tree
-        cacheproxy = manager.list()
-        cacheproxy.append({})
-        self.cacheproxy = cacheproxy
-        self.cache = cacheproxy[0]
-        self.cache['tree'] = {}
-        self.cache['path_id'] = {}
-        self.cache['binaries'] = {}
-        self.cache['st'] = {}
-        self.cacheproxy[0] = self.cache
-
-        """treeproxy = manager.list()
-        treeproxy.append({})
-        self.treeproxy = treeproxy
-        self.tree = treeproxy[0]
-        # Init path_id
-        pathproxy = manager.list()
-        pathproxy.append({})
-        self.path_id = pathproxy[0]
-        # Init st
-        stproxy = manager.list()
-        stproxy.append({})
-        self.st = stproxy[0]
-        # Init bianries
-        binaryproxy = manager.list()
-        binaryproxy.append({})
-        self.binaries = binaryproxy[0]"""
-        # Init variables
-        self.init_variables("")
-        #self.treeproxy[0] = self.tree
-        #pathproxy[0] = self.path_id
-        # Listen API changes to update variables
-        listen = Process(target = self.listen, args = [database, cacheproxy])
-        listen.start()
+        self.database = database
+        self.databases = dbutils.Databases(database)
+        # Cache may be used by several FUSE threads.
+        self.lock = threading.RLock()
+        # Snapshot is saved by the listener and at unmount.
+        self.snapshot_lock = threading.Lock()
+        self.root = Node(None, '', None, FOLDER_MODE)
+        self.nodes = {}
+        self.thread = None
+        self.snapshot_path = os.path.join(
+            CONFIG_FOLDER, database, 'tree.snapshot')
+        self.saved_seq = None
+        self.saved_at = 0
+        self.db_uuid = dbutils.get_db_uuid(self.db)
+
+        if self.load_snapshot():
+            self.replay_changes()
+        else:
+            # Changes made while the tree is loaded are replayed by the
+            # listener.
+            self.last_seq = self.db.info()['update_seq']
+            self.init_variables()
+        self.save_snapshot()
+
+    @property
+    def db(self):
+        return self.databases.db
 
 
     # Tree initialization
 
-    def init_variables(self, path):
+    def init_variables(self):
+        """
+        Initialize tree with all folders and files of the database, read
+        from paged views: the number of requests does not depend on the
+        number of folders.
+        """
+        count = 0
+        for view in ['folder/all', 'file/all']:
+            for row in dbutils.iter_view(self.db, view, include_docs=True):
+                self.add_document(row.doc)
+                count += 1
+        logger.info('Tree loaded, %s documents' % count)
+
+    def replay_changes(self):
+        """
+        Apply changes made in the database since the tree was saved.
+        """
+        count = 0
+        while True:
+            changes = self.db.changes(since=self.last_seq,
+                                      include_docs=True,
+                                      limit=dbutils.VIEW_BATCH_SIZE)
+            for line in changes['results']:
+                self.apply_change(line)
+            count += len(changes['results'])
+            if len(changes['results']) < dbutils.VIEW_BATCH_SIZE:
+                break
+        logger.info('Tree loaded from snapshot, %s changes applied' % count)
+
+    def load_snapshot(self):
+        """
+        Load tree saved by a previous mount. Return False if there is no
+        usable snapshot.
+        """
+        try:
+            with open(self.snapshot_path, 'rb') as snapshot:
+                data = cPickle.load(snapshot)
+        except IOError:
+            return False
+        except Exception:
+            logger.exception('Cannot read tree snapshot')
+            return False
+        if data.get('version') != SNAPSHOT_VERSION:
+            return False
+        if data['db_uuid'] != self.db_uuid:
+            logger.info('Tree snapshot is from another database, ignored')
+            return False
+
+        # A database recreated since the snapshot may also be older than
+        # the snapshot.
+        update_seq = self.db.info()['update_seq']
+        if isinstance(update_seq, int) and data['last_seq'] > update_seq:
+            logger.info('Tree snapshot is newer than database, ignored')
+            return False
+
+        # Nodes are saved parents first, with the index of their parent.
+        nodes = [self.root]
+        for (parent, id, name, mode, size, mtime, binary_id, binary_rev) \
+                in data['nodes']:
+            node = Node(id, intern(name), nodes[parent], mode)
+            (node.size, node.mtime) = (size, mtime)
+            (node.binary_id, node.binary_rev) = (binary_id, binary_rev)
+            node.parent.children[node.name] = node
+            if id is not None:
+                self.nodes[id] = node
+            nodes.append(node)
+
+        self.last_seq = data['last_seq']
+        self.saved_seq = self.last_seq
+        return True
+
+    def save_snapshot(self):
         """
-        Initialize tree
+        Save tree to disk if it changed since it was last saved. Snapshot is
+        written to a temporary file first, so a crash never leaves a partial
+        snapshot. Only one thread writes the snapshot at a time.
         """
-        res = self.db.view('file/byFolder', key=path)
-        for doc in res:
-            doc = doc['value']
-            self.add_document(doc)
-        res = self.db.view('folder/byFolder', key=path)
-        for folder in res:
-            folder = folder['value']
-            self.add_document(folder)
-            self.init_variables(folder['path'] + '/' + folder['name'])
+        with self.snapshot_lock:
+            with self.lock:
+                if self.saved_seq == self.last_seq:
+                    return
+                # Plain tuples are much faster to pickle than nodes.
+                nodes = []
+                indexes = {id(self.root): 0}
+                folders = [self.root]
+                while folders:
+                    folder = folders.pop()
+                    for node in folder.children.itervalues():
+                        indexes[id(node)] = len(nodes) + 1
+                        nodes.append((indexes[id(folder)], node.id, node.name,
+                                      node.mode, node.size, node.mtime,
+                                      node.binary_id, node.binary_rev))
+                        if node.is_folder():
+                            folders.append(node)
+                data = cPickle.dumps({
+                    'version': SNAPSHOT_VERSION,
+                    'db_uuid': self.db_uuid,
+                    'last_seq': self.last_seq,
+                    'nodes': nodes,
+                }, cPickle.HIGHEST_PROTOCOL)
+                seq = self.last_seq
+
+            folder = os.path.dirname(self.snapshot_path)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            with open(self.snapshot_path + '.tmp', 'wb') as snapshot:
+                snapshot.write(data)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.rename(self.snapshot_path + '.tmp', self.snapshot_path)
+            self.saved_seq = seq
+            self.saved_at = time.time()
+            logger.info('Tree snapshot saved at sequence %s' % seq)
 
 
     # Fonction to recover cache
 
     def get_children(self, path):
         """
-        Return children of a path
+        Return children names of a path, sorted.
         """
-        self.receive()
-        if path in self.cache['tree']:
-            return self.cache['tree'][path]
-        else:
-            return ""
+        with self.lock:
+            node = self._find(path)
+            if node is not None and node.is_folder():
+                return sorted(name for (name, child)
+                              in node.children.iteritems()
+                              if child.id is not None)
+            else:
+                return []
+
+    def get_entries(self, path):
+        """
+        Return children of a path as (name, type, inode) tuples, sorted by
+        name. Type is the file type bits of the mode, as expected by
+        directory entries. Listing a folder does not require a stat per
+        child this way.
+        """
+        with self.lock:
+            node = self._find(path)
+            if node is None or not node.is_folder():
+                return []
+            entries = []
+            for name in sorted(node.children):
+                child = node.children[name]
+                if child.id is not None:
+                    entries.append(
+                        (name, child.mode >> 12, child.get_inode()))
+            return entries
 
     def find_file(self, path, name):
         """
@@ -150,206 +377,214 @@ class Cache():
             path {String}: path of document
             name {String}: name of document
         """
-        self.receive()
-        if path is "":
-            path = "/"
-        if path in self.cache['tree']:
-            if name in self.cache['tree'][path]:
-                return True
-            else:
+        with self.lock:
+            node = self._find(path)
+            if node is None or not node.is_folder():
                 return False
-        else:
-            return False
+            child = node.children.get(_encode(name))
+            return child is not None and child.id is not None
 
     def get_binary(self, path):
-        self.receive()
-        if path in self.cache['binaries']:
-            return self.cache['binaries'][path]
-        else:            
-            file_doc = dbutils.get_file(self.db, path)
-            if file_doc is not None:
-                binary_id = file_doc["binary"]["file"]["id"]
-                self.cache['binaries'][path] = binary_id
-                return binary_id
-            else:
-                return False
-
-    def get_st(self, path):
-        self.receive()
-        if path in self.cache['st']:
-            logger.info('st : cache')
-            return self.cache['st'][path]
+        """
+        Return binary informations (id and rev) of file located at path,
+        or False if the file has no binary (empty files).
+        """
+        with self.lock:
+            node = self._find(path)
+            if node is not None:
+                if node.binary_id is None:
+                    return False
+                return {'id': node.binary_id, 'rev': node.binary_rev}
+
+        # Database is queried without holding the lock, so other threads
+        # are not blocked meanwhile.
+        file_doc = dbutils.get_file(self.db, path)
+        if file_doc is not None and "file" in file_doc.get("binary", {}):
+            return file_doc["binary"]["file"]
         else:
-            try:
-                st = CouchStat()
-
-                # Path is root
-                if path is "/":
-                    st.st_mode = stat.S_IFDIR | 0o775
-                    st.st_nlink = 2
-                    self.cache['st'][path] = st
-                    return st
-
-                else:
-                    # Or path is a folder
-                    folder = dbutils.get_folder(self.db, path)
-                    if folder is not None:
-                        st.st_mode = stat.S_IFDIR | 0o775
-                        st.st_nlink = 2
-                        if 'lastModification' in folder:
-                            st.st_atime = get_date(folder['lastModification'])
-                            st.st_ctime = st.st_atime
-                            st.st_mtime = st.st_atime
-                        self.cache['st'][path] = st
-                        return st
-
-                    else:
-                        # Or path is a file
-                        file_doc = dbutils.get_file(self.db, path)
-
-                        if file_doc is not None:
-                            st.st_mode = stat.S_IFREG | 0o664
-                            st.st_nlink = 1
-                            # TODO: if size is not set, get the binary
-                            # and save the information.
-                            st.st_size = file_doc.get('size', 4096)
-                            if 'lastModification' in file_doc:
-                                st.st_atime = \
-                                    get_date(file_doc['lastModification'])
-                                st.st_ctime = st.st_atime
-                                st.st_mtime = st.st_atime
-                            self.cache['st'][path] = st
-                            return st
-
-                        else:
-                            print 'File does not exist: %s' % path
-                            logger.info('file_not_fount')
-                            return st
-                self.send()
-
-            except Exception as e:
-                logger.exception(e)
-                return e
+            return False
 
+    def get_st(self, path):
+        """
+        Return stat of file or folder located at path, or None if it does
+        not exist. Stats are built from the tree, the database is only
+        queried for paths whose folder is not in the tree.
+        """
+        with self.lock:
+            node = self._find(path)
+            if node is not None:
+                return node.get_st()
+            # Content of known folders is complete: the path does not exist.
+            (folder_path, name) = _path_split(path)
+            folder = self._find(folder_path)
+            if folder is not None and folder.is_folder():
+                return None
+
+        # Database is queried without holding the lock, so other threads
+        # are not blocked meanwhile.
+        try:
+            doc = dbutils.get_folder(self.db, path)
+            if doc is None:
+                doc = dbutils.get_file(self.db, path)
+            if doc is None:
+                logger.debug('File does not exist: %s' % path)
+                return None
+            node = Node(None, None, None, _get_mode(doc))
+            node.update(doc)
+            return node.get_st()
+
+        except Exception as e:
+            logger.exception(e)
+            return e
+
+    def set_mtime(self, path, date):
+        '''
+        Set modification date of the file or folder located at *path*,
+        before its document is saved.
+        '''
+        with self.lock:
+            node = self._find(path)
+            if node is not None:
+                node.mtime = get_date(date)
 
+    def _find(self, path):
+        '''
+        Return node located at given path, or None. Folders whose document
+        was not found are hidden, with their content.
+        '''
+        node = self.root
+        for name in _encode(path).split('/'):
+            if name == '':
+                continue
+            if node.children is None:
+                return None
+            node = node.children.get(name)
+            if node is None or node.id is None:
+                return None
+        return node
+
+    def _get_folder(self, path):
+        '''
+        Return folder node located at given path. Missing folders are
+        created, they are completed when their document is added. Until
+        then they have no id and are hidden.
+        '''
+        node = self.root
+        for name in _encode(path).split('/'):
+            if name == '':
+                continue
+            child = node.children.get(name)
+            if child is None or not child.is_folder():
+                child = Node(None, intern(name), node, FOLDER_MODE)
+                node.children[child.name] = child
+            node = child
+        return node
 
     # Manage Tree
 
     def add_document(self, doc):
         '''
-        Add document 'doc' in Tree
+        Add document 'doc' in Tree, or update it if it is already there.
         '''
-        self.receive()
-        logger.info('add_document %s' %doc)
-        # Update tree
-        if doc['path'] == "":
-            path = '/'
-        else:
-            path = doc['path']
-        if path in self.cache['tree']:
-            self.cache['tree'][path].append(doc['name'])
-        else:
-            self.cache['tree'][path] = [doc['name']]
-        # Update path_id
-        self.cache['path_id'][doc['_id']] = doc['path'] + '/' + doc['name']
-        self.send()
+        self.update_document(doc)
 
     def delete_document(self, doc):
         '''
         Delete document 'doc' in Tree
         '''
-        self.receive()
-        # Update tree
-        full_path = self.cache['path_id'][doc['_id']]
-        folder_path, name = _path_split(full_path)
-        if folder_path == "":
-            folder_path = '/'
-        self.cache['tree'][folder_path].remove(name)
-        if full_path in self.cache['tree']:
-            del self.cache['tree'][full_path]
-        # Update path_id
-        del self.cache['path_id'][doc['_id']]
-        # Update st
-        if full_path in self.cache['st']:
-            del self.cache['st'][full_path]    
-        # Update binaries
-        if full_path in self.cache['binaries']:
-            del self.cache['binaries'][full_path]
-        self.send()
-
-    def update_file(self, doc):
+        with self.lock:
+            node = self.nodes.pop(_encode(doc['_id']), None)
+            if node is None:
+                return
+            if node.parent.children.get(node.name) is node:
+                del node.parent.children[node.name]
+            # Content of a removed folder is removed too.
+            folders = [node]
+            while folders:
+                folder = folders.pop()
+                for child in (folder.children or {}).itervalues():
+                    self.nodes.pop(child.id, None)
+                    folders.append(child)
+
+    def update_document(self, doc):
         '''
-        Updtate file 'doc' in Tree
+        Add document 'doc' in Tree, or update it if it is already there. A
+        folder moved to another path is moved with its content.
         '''
-        self.receive()
-        self.delete_document(doc)
-        self.add_document(doc)
-        """
-        old_full_path = self.cache['path_id'][doc['_id']]
-        old_path, old_name = _path_split(old_full_path)
-        full_path = doc['path'] + '/' + doc['name']
-        if old_full_path != full_path:
-            # Remove old path
-            self.cache['tree'][old_path].remove(old_name))
-            st = self.cache['st'][old_full_path]
-            del self.cache['st'][old_full_path]
-            binary_id = self.cache['binaries'][old_full_path]
-            del self.cache['binaries'][old_full_path]
-            # Add new path
-            if 
-            self.cache['tree'][doc['path'].append(doc['name'])
-
-        if doc['lastModification'] != self.cache['st'][full_path].lastModification
-
-
-        logger.info('update_file %s' %doc)
-        """
-        self.send()
-        print('update_file')
+        with self.lock:
+            logger.debug('update_document %s', doc['_id'])
+            doc_id = _encode(doc['_id'])
+            name = intern(_encode(doc['name']))
+            parent = self._get_folder(doc['path'])
+            node = self.nodes.get(doc_id)
+
+            if node is None:
+                # Folder may have been created before, by one of its
+                # children.
+                node = parent.children.get(name)
+                if node is None or node.id is not None \
+                        or node.mode != _get_mode(doc):
+                    node = Node(doc_id, name, parent, _get_mode(doc))
+            elif node.parent.children.get(node.name) is node:
+                del node.parent.children[node.name]
+
+            node.name = name
+            node.parent = parent
+            node.update(doc)
+            placeholder = parent.children.get(name)
+            if placeholder is not None and placeholder is not node \
+                    and placeholder.id is None and node.is_folder():
+                # Children moved to the folder before it arrived are kept.
+                for child in placeholder.children.itervalues():
+                    child.parent = node
+                    node.children[child.name] = child
+            parent.children[name] = node
+            self.nodes[doc_id] = node
 
-    def update_folder(self, doc):
+    # Listen update
+
+    def start(self):
         '''
-        Updtate folder 'doc' in Tree
-        TODOS
+        Start listening to database changes in a background thread.
         '''
-        self.receive()
-        logger.info('update_folder %s' %doc)
-        self.send()
-        print('update_folder')
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.listen)
+            self.thread.daemon = True
+            self.thread.start()
 
-    # Listen update
-
-    def listen(self, database, cacheproxy):
+    def listen(self):
         """
         Listen API changes of couchDB and update tree when it is necessary
         TODOS : use filter (cache/all)
         """
-        dbutils.init_database_views('laptop')
-        self.cacheproxy = cacheproxy
-        self.cache = cacheproxy[0]
-        db = dbutils.get_db(database)
-        sequences = db.changes(include_docs = False, feed='normal')
-        all_changes = db.changes(feed='continuous',
-                                    since= sequences['last_seq'],
-                                    heartbeat='1000',
-                                    include_docs=True)
-        for line in all_changes:
-            logger.info(line)
-            if self._is_deleted(line):
-                logger.info('_is_deleted')
-                if line['doc']['_id'] in self.cache['path_id']:
-                    self.delete_document(line['doc'])
-            else:
-                if self._is_file(line): 
-                    if self._is_new(line):
-                        self.add_document(line['doc'])
-                    else:
-                        self.update_file(line['doc'])
-                elif self._is_folder(line):
-                    if self._is_new(line):
-                        self.add_document(line['doc'])
-                    else:
-                        self.update_folder(line['doc'])
+        dbutils.init_database_views(self.database)
+        while True:
+            try:
+                all_changes = self.db.changes(feed='continuous',
+                                              since=self.last_seq,
+                                              heartbeat='1000',
+                                              include_docs=True)
+                for line in all_changes:
+                    self.apply_change(line)
+                    if time.time() - self.saved_at > SNAPSHOT_INTERVAL:
+                        self.save_snapshot()
+            except Exception:
+                logger.exception('Cannot listen to database changes')
+            time.sleep(LISTEN_RETRY_DELAY)
+
+    def apply_change(self, line):
+        '''
+        Update tree with a line of the changes feed.
+        '''
+        logger.debug(line)
+        if 'seq' not in line:
+            return
+        if self._is_deleted(line):
+            logger.info('_is_deleted')
+            self.delete_document(line['doc'])
+        elif self._is_file(line) or self._is_folder(line):
+            self.update_document(line['doc'])
+        self.last_seq = line['seq']
 
     def _is_file(self, line):
         '''
@@ -369,12 +604,6 @@ class Cache():
         except:
             return False
 
-    def _is_new(self, line):
-        '''
-        Document is considered as new if its revision starts by "1-"
-        '''
-        return line['doc']['_rev'][0:2] == "1-"
-
     def _is_deleted(self, line):
         '''
         Document is considered as deleted if deleted key has for value true.
@@ -382,12 +611,6 @@ class Cache():
         return 'deleted' in line and line['deleted'] and \
                line['deleted'] is True
 
-    def send(self):
-        self.cacheproxy[0] = self.cache
-
-    def receive(self):
-        self.cache = self.cacheproxy[0]
-
 
 
 # Helpers
@@ -405,6 +628,22 @@ def _normalize_path(path):
     else:
         return '/' + path
 
+def _encode(text):
+    '''
+    Encode text from the database to UTF-8, like paths given by FUSE.
+    '''
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+def _get_mode(doc):
+    '''
+    Return file mode of the file or folder described by *doc*.
+    '''
+    if str(doc.get('docType')).lower() == "folder":
+        return FOLDER_MODE
+    return FILE_MODE
+
 def _path_split(path):
     '''
     Split folder path and file name.
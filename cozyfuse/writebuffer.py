@@ -0,0 +1,247 @@
+import os
+import logging
+import tempfile
+import threading
+import cStringIO
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+# Size (in bytes) above which written data are moved to disk.
+DEFAULT_SPILL_SIZE = 4 * 1024 * 1024
+# Size (in bytes) of the parts copied from the base content.
+DEFAULT_BLOCK_SIZE = 256 * 1024
+
+
+class WriteBuffer():
+    '''
+    Working copy of an open file, modified before it is saved to the
+    database.
+
+    Data are stored at the offset they are written to. They are kept in
+    memory until they exceed *spill_size*, then they are moved to a
+    temporary (sparse) file in *folder*, so memory usage stays bounded
+    whatever the size of the written file.
+
+    The working copy starts from the current content of the file, *base*
+    (an object providing get_size() and read(size, offset)). Base content
+    is copied lazily, block by block: only blocks partially overwritten
+    are copied on write, remaining blocks are copied once, when the whole
+    content is requested for saving. Truncating the file to zero does not
+    read the base content at all.
+
+    write(), read(), truncate() and get_size() can be called from several
+    threads.
+    '''
+
+    def __init__(self, folder, base=None, spill_size=DEFAULT_SPILL_SIZE,
+                 block_size=DEFAULT_BLOCK_SIZE):
+        self.folder = folder
+        self.base = base
+        self.spill_size = spill_size
+        self.block_size = block_size
+        self.file = cStringIO.StringIO()
+        self.path = None
+        # Size of the data stored in the buffer file.
+        self.file_size = 0
+        # Blocks of the base content that are in the buffer file.
+        self.blocks = set()
+        self.lock = threading.RLock()
+        if base is None:
+            self.base_size = 0
+            self.size = 0
+        else:
+            self.base_size = None
+            self.size = None
+
+    def write(self, buf, offset):
+        '''
+        Write *buf* at *offset*.
+        '''
+        if len(buf) == 0:
+            return 0
+        with self.lock:
+            self._load_base()
+            end = offset + len(buf)
+            first = offset // self.block_size
+            last = (end - 1) // self.block_size
+
+            # Blocks only partially overwritten must be copied first.
+            for block in set([first, last]):
+                start = block * self.block_size
+                stop = min(start + self.block_size, self.base_size)
+                if block not in self.blocks and start < self.base_size \
+                        and (offset > start or end < stop):
+                    self._copy_block(block)
+
+            self._write(buf, offset)
+            self.blocks.update(range(first, last + 1))
+            self.size = max(self.size, end)
+            return len(buf)
+
+    def read(self, size, offset):
+        '''
+        Return *size* bytes of the working copy, starting at *offset*.
+        '''
+        with self.lock:
+            self._load_base()
+            end = min(offset + size, self.size)
+            parts = []
+            position = offset
+            while position < end:
+                block = position // self.block_size
+                stop = min((block + 1) * self.block_size, end)
+                if position < self.base_size and block not in self.blocks:
+                    stop = min(stop, self.base_size)
+                    parts.append(_pad(
+                        self.base.read(stop - position, position),
+                        stop - position))
+                else:
+                    parts.append(self._read(stop - position, position))
+                position = stop
+            return ''.join(parts)
+
+    def get_size(self):
+        with self.lock:
+            self._load_base()
+            return self.size
+
+    def truncate(self, length):
+        '''
+        Change size of the working copy to *length*. Data beyond current
+        size read as zeros.
+        '''
+        with self.lock:
+            if length == 0:
+                self.base_size = 0
+                self.size = 0
+            else:
+                self._load_base()
+            self.base_size = min(self.base_size, length)
+            if self.file_size > length:
+                self.file.truncate(length)
+                self.file_size = length
+            self.blocks = set(block for block in self.blocks
+                              if block * self.block_size < length)
+            self.size = length
+
+    def getvalue(self):
+        '''
+        Return the whole content.
+        '''
+        return self.stream().read(self.size)
+
+    def stream(self):
+        '''
+        Return a file object to read the whole content from the start,
+        without copying it.
+        '''
+        self._materialize()
+        self.file.flush()
+        self.file.seek(0)
+        return self.file
+
+    def save(self, path):
+        '''
+        Move whole content to *path*. Data are synced to disk before this
+        method returns.
+        '''
+        self._materialize()
+        if self.path is None:
+            with open(path, 'wb') as saved:
+                saved.write(self.file.getvalue())
+                saved.flush()
+                os.fsync(saved.fileno())
+        else:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            os.rename(self.path, path)
+            self.path = None
+
+    def close(self):
+        '''
+        Free memory or remove temporary file.
+        '''
+        self.file.close()
+        if self.path is not None:
+            os.remove(self.path)
+            self.path = None
+
+    def _load_base(self):
+        '''
+        Get size of the base content, the first time it is needed.
+        '''
+        if self.base_size is None:
+            self.base_size = self.base.get_size()
+            self.size = self.base_size
+
+    def _materialize(self):
+        '''
+        Copy base blocks that are not in the buffer file yet, so the buffer
+        file holds the whole content.
+        '''
+        self._load_base()
+        block_count = (self.base_size + self.block_size - 1) // self.block_size
+        for block in range(block_count):
+            if block not in self.blocks:
+                self._copy_block(block)
+                self.blocks.add(block)
+        if self.file_size < self.size:
+            # Extend file up to its size, missing data read as zeros.
+            self._write('\0', self.size - 1)
+
+    def _copy_block(self, block):
+        start = block * self.block_size
+        length = min(self.block_size, self.base_size - start)
+        self._write(_pad(self.base.read(length, start), length), start)
+
+    def _write(self, buf, offset):
+        end = offset + len(buf)
+        if self.path is None and end > self.spill_size:
+            self._spill()
+
+        # Sequential writes do not need to move the file position.
+        if self.file.tell() != offset:
+            self.file.seek(offset)
+        self.file.write(buf)
+        self.file_size = max(self.file_size, end)
+
+    def _read(self, size, offset):
+        self.file.seek(offset)
+        return _pad(self.file.read(size), size)
+
+    def _spill(self):
+        '''
+        Move data from memory to a temporary file.
+        '''
+        (fd, path) = tempfile.mkstemp(dir=self.folder, suffix='.buffer')
+        spilled = os.fdopen(fd, 'w+b')
+        spilled.write(self.file.getvalue())
+        self.file.close()
+        self.file = spilled
+        self.path = path
+        logger.debug('Write buffer moved to %s' % path)
+
+
+def _pad(data, size):
+    '''
+    Complete *data* with zeros up to *size* bytes.
+    '''
+    if len(data) < size:
+        data += '\0' * (size - len(data))
+    return data
+
+
+def clean(folder):
+    '''
+    Create the folder for write buffers, or remove buffers left by a
+    previous mount.
+    '''
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    for name in os.listdir(folder):
+        if name.endswith('.buffer'):
+            os.remove(os.path.join(folder, name))
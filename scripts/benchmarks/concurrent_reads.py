@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+'''
+Measure how reads on a mounted folder scale with the number of concurrent
+readers. Mount the folder with and without --multithreaded and compare:
+
+    python concurrent_reads.py ~/cozy-mount --threads 1 2 4 8
+
+Reader threads read whole files of the given folder (recursively). Each
+run reads different files, so contents are not in the local cache yet and
+the benchmark mostly measures how many requests to the database run at the
+same time.
+'''
+import os
+import sys
+import time
+import argparse
+import threading
+import Queue
+
+CHUNK_SIZE = 128 * 1024
+
+
+def list_files(folder, limit):
+    '''
+    Return up to *limit* file paths found in *folder*.
+    '''
+    paths = []
+    for (dirpath, dirnames, filenames) in os.walk(folder):
+        for filename in filenames:
+            paths.append(os.path.join(dirpath, filename))
+            if len(paths) >= limit:
+                return paths
+    return paths
+
+
+def read_files(queue, results):
+    '''
+    Read files from *queue* until it is empty, add the number of bytes read
+    to *results*.
+    '''
+    total = 0
+    while True:
+        try:
+            path = queue.get_nowait()
+        except Queue.Empty:
+            break
+        with open(path, 'rb') as content:
+            while True:
+                chunk = content.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                total += len(chunk)
+            # Stat from the same thread, like a file manager would.
+            os.stat(path)
+    results.append(total)
+
+
+def run(paths, thread_count):
+    '''
+    Read all *paths* with *thread_count* threads. Return elapsed time and
+    number of bytes read.
+    '''
+    queue = Queue.Queue()
+    for path in paths:
+        queue.put(path)
+    results = []
+    threads = [threading.Thread(target=read_files, args=(queue, results))
+               for index in range(thread_count)]
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (time.time() - start, sum(results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('folder', help='Mounted folder to read files from')
+    parser.add_argument('--threads', type=int, nargs='+',
+                        default=[1, 2, 4, 8],
+                        help='Numbers of concurrent readers to try')
+    parser.add_argument('--files', type=int, default=200,
+                        help='Maximum number of files read per run')
+    args = parser.parse_args()
+
+    paths = list_files(args.folder, args.files * len(args.threads))
+    if len(paths) < len(args.threads):
+        print 'Not enough files found in %s' % args.folder
+        sys.exit(1)
+    per_run = len(paths) // len(args.threads)
+
+    print '%s files per run' % per_run
+    print '%8s %10s %10s %10s' % ('threads', 'seconds', 'files/s', 'MB/s')
+    for (index, thread_count) in enumerate(args.threads):
+        run_paths = paths[index * per_run:(index + 1) * per_run]
+        (elapsed, size) = run(run_paths, thread_count)
+        print '%8d %10.2f %10.1f %10.2f' % (
+            thread_count,
+            elapsed,
+            len(run_paths) / elapsed,
+            size / elapsed / 1024 / 1024)
+
+
+if __name__ == '__main__':
+    main()
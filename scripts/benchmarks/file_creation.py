@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+'''
+Measure how fast files are created in a mounted folder, like an archive
+extraction or a repository clone would do:
+
+    python file_creation.py ~/cozy-mount --files 1000 --size 4
+
+Files are created in a new folder of the mounted folder, spread over
+sub-folders of --per-folder files. Each file is created, written and
+closed, then the creation rate is printed. The folder is removed at the
+end unless --keep is given.
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+
+
+def create_files(folder, count, per_folder, size):
+    '''
+    Create *count* files of *size* bytes in sub-folders of *folder*. Return
+    the elapsed time.
+    '''
+    content = 'x' * size
+    start = time.time()
+    for index in range(count):
+        if index % per_folder == 0:
+            subfolder = os.path.join(
+                folder, 'folder%05d' % (index // per_folder))
+            os.mkdir(subfolder)
+        path = os.path.join(subfolder, 'file%06d.txt' % index)
+        with open(path, 'wb') as created:
+            created.write(content)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('folder', help='Mounted folder to create files in')
+    parser.add_argument('--files', type=int, default=1000,
+                        help='Number of files to create')
+    parser.add_argument('--per-folder', type=int, default=100,
+                        help='Number of files per sub-folder')
+    parser.add_argument('--size', type=int, default=4,
+                        help='Size (in KB) of created files, 0 for empty '
+                             'files')
+    parser.add_argument('--keep', action='store_true',
+                        help='Do not remove created files')
+    args = parser.parse_args()
+
+    folder = os.path.join(args.folder, 'benchmark-%d' % time.time())
+    os.mkdir(folder)
+    try:
+        elapsed = create_files(folder, args.files, args.per_folder,
+                               args.size * 1024)
+    finally:
+        if not args.keep:
+            shutil.rmtree(folder)
+
+    print '%10s %10s %10s' % ('files', 'seconds', 'files/s')
+    print '%10d %10.2f %10.1f' % (args.files, elapsed, args.files / elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+'''
+Measure operations of the in-memory tree on large flat folders:
+
+    python tree_operations.py --entries 100000
+
+The tree is filled directly, without database: it measures the cost of
+the tree itself for getattr, open, readdir, unlink and rename, and the
+memory it uses per entry.
+'''
+import os
+import sys
+import time
+import random
+import argparse
+import resource
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from cozyfuse import dbutils, tree
+
+
+class EmptyDatabase():
+    '''
+    Database without documents, the tree is filled by the benchmark.
+    '''
+
+    def info(self):
+        return {'update_seq': 0}
+
+    def view(self, name, **options):
+        return []
+
+
+class EmptyDatabases():
+
+    def __init__(self, database):
+        self.db = EmptyDatabase()
+
+
+def make_doc(index):
+    return {
+        '_id': 'file%08d' % index,
+        'docType': 'File',
+        'path': '/photos',
+        'name': u'IMG_%08d.jpg' % index,
+        'size': 1024,
+        'lastModification': '2014-05-07T09:17:48',
+        'binary': {'file': {'id': 'binary%08d' % index, 'rev': '1-a'}},
+    }
+
+
+def measure(name, count, function):
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    print '%-10s %10d %12.2f %12.0f' % (
+        name, count, elapsed * 1000, count / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--entries', type=int, default=100000,
+                        help='Number of files in the folder')
+    parser.add_argument('--lookups', type=int, default=10000,
+                        help='Number of lookups, removals and renames')
+    args = parser.parse_args()
+
+    dbutils.Databases = EmptyDatabases
+    tree.CONFIG_FOLDER = tempfile.mkdtemp()
+    cache = tree.Cache('benchmark')
+    cache.add_document({'_id': 'folder', 'docType': 'Folder',
+                        'path': '', 'name': 'photos'})
+
+    docs = [make_doc(index) for index in range(args.entries)]
+    sample = random.sample(docs, min(args.lookups, len(docs)))
+
+    def add():
+        for doc in docs:
+            cache.add_document(doc)
+
+    def getattr():
+        for doc in sample:
+            cache.get_st('/photos/' + doc['name'])
+
+    def open():
+        for doc in sample:
+            cache.find_file('/photos', doc['name'])
+
+    def readdir():
+        cache.get_entries('/photos')
+
+    def rename():
+        for doc in sample:
+            doc['name'] = 'renamed-' + doc['name']
+            cache.update_document(doc)
+
+    def unlink():
+        for doc in sample:
+            cache.delete_document(doc)
+
+    print '%s entries in /photos' % args.entries
+    print '%-10s %10s %12s %12s' % ('operation', 'count', 'total (ms)',
+                                    'per second')
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    measure('add', len(docs), add)
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory
+    measure('getattr', len(sample), getattr)
+    measure('open', len(sample), open)
+    measure('readdir', 1, readdir)
+    measure('rename', len(sample), rename)
+    measure('unlink', len(sample), unlink)
+    # ru_maxrss is in KB on Linux.
+    print 'memory: %.0f bytes per entry' % (memory * 1024.0 / len(docs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import pytest
+import sys
+import os
+import errno
+import shutil
+import httpretty
+
+from couchdb import Database
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+
+import cozyfuse.binarycache as binarycache
+import cozyfuse.dbutils as dbutils
+import cozyfuse.writebuffer as writebuffer
+
+TESTDB = 'cozy-fuse-test'
+DB_URL = 'http://localhost:5984/%s' % TESTDB
+CONTENT = ''.join(chr(ord('a') + i % 26) for i in range(10000))
+BLOCK_SIZE = 1024
+
+
+def serve_range(request, uri, headers):
+    '''
+    Answer attachment requests like CouchDB does with Range headers.
+    '''
+    if 'range' not in request.headers:
+        return (200, headers, CONTENT)
+    (start, end) = request.headers['range'][len('bytes='):].split('-')
+    (start, end) = (int(start), min(int(end), len(CONTENT) - 1))
+    if start >= len(CONTENT):
+        return (416, headers, '')
+    headers['content-range'] = 'bytes %s-%s/%s' % (start, end, len(CONTENT))
+    return (206, headers, CONTENT[start:end + 1])
+
+
+def serve_full(request, uri, headers):
+    return (200, headers, CONTENT)
+
+
+@pytest.fixture
+def cache(request):
+    folder = os.path.join(local_config.CONFIG_FOLDER, TESTDB, 'cache')
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+
+    httpretty.enable()
+    httpretty.register_uri(httpretty.GET, DB_URL + '/binary1/file',
+                           body=serve_range)
+    httpretty.register_uri(httpretty.GET, DB_URL + '/binary2/file',
+                           body=serve_range)
+    httpretty.register_uri(httpretty.GET, DB_URL + '/binary3/file',
+                           body=serve_full)
+    httpretty.register_uri(httpretty.GET, DB_URL + '/nobinary/file',
+                           status=404, body='{"error": "not_found"}',
+                           content_type='application/json')
+    httpretty.register_uri(httpretty.HEAD, DB_URL + '/nobinary',
+                           status=200, body='')
+    # Revision not replicated yet.
+    httpretty.register_uri(httpretty.GET, DB_URL + '/missing/file',
+                           status=404, body='{"error": "not_found"}',
+                           content_type='application/json')
+    httpretty.register_uri(httpretty.HEAD, DB_URL + '/missing',
+                           status=404, body='')
+
+    def fin():
+        httpretty.disable()
+        httpretty.reset()
+    request.addfinalizer(fin)
+
+    return binarycache.BinaryCache(Database(DB_URL), TESTDB,
+                                   block_size=BLOCK_SIZE)
+
+
+def test_read(cache):
+    assert CONTENT[:10] == cache.read('binary1', '1-a', 10, 0)
+    assert CONTENT[100:150] == cache.read('binary1', '1-a', 50, 100)
+    assert CONTENT[1000:3000] == cache.read('binary1', '1-a', 2000, 1000)
+    assert CONTENT[-4:] == cache.read('binary1', '1-a', 100, len(CONTENT) - 4)
+    assert '' == cache.read('binary1', '1-a', 10, len(CONTENT))
+
+
+def test_read_fetches_only_missing_blocks(cache):
+    cache.read('binary1', '1-a', 10, 0)
+    assert 'bytes=0-1023' == \
+        httpretty.last_request().headers['range']
+    cache.read('binary1', '1-a', 10, 10)
+    assert 1 == len(httpretty.HTTPretty.latest_requests)
+    cache.read('binary1', '1-a', 3000, 0)
+    assert 'bytes=1024-3071' == \
+        httpretty.last_request().headers['range']
+    assert 2 == len(httpretty.HTTPretty.latest_requests)
+    assert 3 * BLOCK_SIZE == cache.size
+
+
+def test_read_new_revision(cache):
+    cache.read('binary1', '1-a', 10, 0)
+    cache.read('binary1', '2-b', 10, 0)
+    assert 2 == len(httpretty.HTTPretty.latest_requests)
+    assert 2 == len(cache.entries)
+
+
+def test_read_without_range_support(cache):
+    assert CONTENT[5000:5010] == cache.read('binary3', '1-a', 10, 5000)
+    assert CONTENT[:10] == cache.read('binary3', '1-a', 10, 0)
+    assert 1 == len(httpretty.HTTPretty.latest_requests)
+    assert len(CONTENT) == cache.size
+
+
+def test_interrupted_transfer_is_retried(cache):
+    requests = []
+
+    def serve_interrupted(request, uri, headers):
+        # First transfer stops in the middle of the second block.
+        requests.append(request)
+        (status, headers, body) = serve_range(request, uri, headers)
+        if len(requests) == 1:
+            body = body[:BLOCK_SIZE + 100]
+        return (status, headers, body)
+
+    httpretty.register_uri(httpretty.GET, DB_URL + '/binary4/file',
+                           body=serve_interrupted)
+    assert CONTENT[:3000] == cache.read('binary4', '1-a', 3000, 0)
+    assert 2 == len(requests)
+    assert 'bytes=1024-3071' == requests[1].headers['range']
+
+
+def test_failing_transfer_raises_eio(cache):
+    def serve_nothing(request, uri, headers):
+        (status, headers, body) = serve_range(request, uri, headers)
+        return (status, headers, '')
+
+    httpretty.register_uri(httpretty.GET, DB_URL + '/binary4/file',
+                           body=serve_nothing)
+    with pytest.raises(IOError) as error:
+        cache.read('binary4', '1-a', 10, 0)
+    assert errno.EIO == error.value.errno
+
+
+def test_read_no_attachment(cache):
+    assert '' == cache.read('nobinary', '1-a', 10, 0)
+    assert 0 == len(cache.entries)
+
+
+def test_read_missing_revision(cache):
+    with pytest.raises(IOError) as error:
+        cache.read('missing', '2-b', 10, 0)
+    assert errno.EIO == error.value.errno
+    content = binarycache.BinaryContent(cache, 'missing', '2-b')
+    with pytest.raises(IOError):
+        content.get_size()
+    assert 0 == len(cache.entries)
+
+
+def test_add_uploaded_content(cache):
+    folder = os.path.join(local_config.CONFIG_FOLDER, 'buffers')
+    writebuffer.clean(folder)
+    content = writebuffer.WriteBuffer(folder)
+    content.write('uploaded', 0)
+    cache.add('binary1', '2-b', content)
+    content.close()
+    assert 'loaded' == cache.read('binary1', '2-b', 10, 2)
+    assert 0 == len(httpretty.HTTPretty.latest_requests)
+
+
+def test_eviction(cache):
+    cache.max_size = len(CONTENT) + 1
+    cache.read('binary1', '1-a', len(CONTENT), 0)
+    cache.read('binary2', '1-a', len(CONTENT), 0)
+    assert 1 == len(cache.entries)
+    assert len(CONTENT) == cache.size
+    assert 2 == len(os.listdir(cache.folder))
+
+
+def test_entries_are_reloaded(cache):
+    cache.read('binary1', '1-a', 10, 0)
+    reloaded = binarycache.BinaryCache(Database(DB_URL), TESTDB,
+                                       block_size=BLOCK_SIZE)
+    assert cache.entries.keys() == reloaded.entries.keys()
+    assert CONTENT[:10] == reloaded.read('binary1', '1-a', 10, 0)
+    assert 1 == len(httpretty.HTTPretty.latest_requests)
+
+
+def test_entries_with_other_block_size_are_removed(cache):
+    cache.read('binary1', '1-a', 10, 0)
+    reloaded = binarycache.BinaryCache(Database(DB_URL), TESTDB,
+                                       block_size=2 * BLOCK_SIZE)
+    assert 0 == len(reloaded.entries)
+    assert 0 == len(os.listdir(cache.folder))
+
+
+def test_connections_are_pooled(cache):
+    pool = cache.resource.session.connection_pool
+    assert isinstance(pool, dbutils.ConnectionPool)
@@ -0,0 +1,283 @@
+import pytest
+import sys
+import os
+import json
+import errno
+import threading
+import httpretty
+
+from couchdb import Database
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+pytest.importorskip('fuse')
+
+import cozyfuse.couchmount as couchmount
+import cozyfuse.folderdates as folderdates
+import cozyfuse.readahead as readahead
+
+TESTDB = 'cozy-fuse-test'
+DB_URL = 'http://localhost:5984/%s' % TESTDB
+
+
+class Cache():
+
+    def __init__(self):
+        self.updates = []
+        self.deletes = []
+        self.children = {}
+
+    def update_document(self, doc):
+        self.updates.append(doc)
+
+    def delete_document(self, doc):
+        self.deletes.append(doc)
+
+    def get_children(self, path):
+        return self.children.get(path, [])
+
+    def set_mtime(self, path, date):
+        pass
+
+
+@pytest.fixture
+def couch_fs(request):
+    '''
+    File system on the test database, without FUSE nor tree.
+    '''
+    couch_fs = couchmount.CouchFSDocument.__new__(couchmount.CouchFSDocument)
+    db = Database(DB_URL)
+    couch_fs.databases = type('', (), {'db': db})()
+    couch_fs.cache = Cache()
+    couch_fs.folder_dates = folderdates.FolderDates(
+        couch_fs._save_folder_dates)
+    couch_fs.lock = threading.RLock()
+    couch_fs.writeBuffers = {}
+    couch_fs.openFiles = {}
+    couch_fs.readahead = readahead.ReadAhead(None)
+    couch_fs.journal = None
+
+    httpretty.enable()
+
+    def fin():
+        httpretty.disable()
+        httpretty.reset()
+    request.addfinalizer(fin)
+    return couch_fs
+
+
+def serve_folders(folders, conflicts=[]):
+    '''
+    Register answers of the folder requests made when dates are saved:
+    *folders* are the existing folder paths, saving those in *conflicts*
+    fails. Return the list of saved documents.
+    '''
+    saved = []
+
+    def serve_view(request, uri, headers):
+        keys = json.loads(request.body)['keys']
+        rows = [{'id': path, 'key': path, 'value': None,
+                 'doc': {'_id': path, '_rev': '1-a', 'path': '',
+                         'name': path[1:], 'docType': 'Folder'}}
+                for path in keys if path in folders]
+        return (200, headers, json.dumps(
+            {'total_rows': len(rows), 'offset': 0, 'rows': rows}))
+
+    def serve_bulk_docs(request, uri, headers):
+        results = []
+        for doc in json.loads(request.body)['docs']:
+            if doc['_id'] in conflicts:
+                results.append({'id': doc['_id'], 'error': 'conflict',
+                                'reason': 'Document update conflict.'})
+            else:
+                saved.append(doc)
+                results.append({'id': doc['_id'], 'rev': '2-b'})
+        return (201, headers, json.dumps(results))
+
+    httpretty.register_uri(
+        httpretty.POST, DB_URL + '/_design/folder/_view/byFullPath',
+        body=serve_view, content_type='application/json')
+    httpretty.register_uri(
+        httpretty.POST, DB_URL + '/_bulk_docs',
+        body=serve_bulk_docs, content_type='application/json')
+    return saved
+
+
+def test_save_folder_dates(couch_fs):
+    saved = serve_folders([u'/\xe9t\xe9', u'/hiver', u'/printemps'],
+                          conflicts=[u'/hiver'])
+    # Paths from FUSE are UTF-8, paths from documents are unicode.
+    couch_fs._save_with_parents([], ['/\xc3\xa9t\xc3\xa9', u'/hiver'])
+    couch_fs._save_with_parents([], [u'/printemps', '/automne'])
+    dates = couch_fs.folder_dates.pending
+    assert ['/automne', '/hiver', '/printemps', '/\xc3\xa9t\xc3\xa9'] == \
+        sorted(dates)
+
+    dates = dict(dates)
+    assert ['/hiver'] == couch_fs._save_folder_dates(dates)
+    assert [u'/printemps', u'/\xe9t\xe9'] == \
+        sorted(doc['_id'] for doc in saved)
+    for doc in saved:
+        assert dates[doc['_id'].encode('utf-8')] == doc['lastModification']
+    assert 2 == len(couch_fs.cache.updates)
+
+
+def test_save_folder_dates_with_wrong_path(couch_fs):
+    saved = serve_folders([u'/hiver'])
+    failed = couch_fs._save_folder_dates(
+        {'/\xe9t\xe9': '2014-05-07T09:17:48',
+         '/hiver': '2014-05-07T09:17:48'})
+    assert [] == failed
+    assert [u'/hiver'] == [doc['_id'] for doc in saved]
+
+
+def serve_rmdir(descendants):
+    '''
+    Register answers of the requests made to remove folder /a, holding
+    *descendants* in the database. Return the list of deleted documents.
+    '''
+    deleted = []
+    views = {
+        'folder/_view/byFullPath': [{'_id': 'a', '_rev': '1-a', 'path': '',
+                                     'name': 'a', 'docType': 'Folder'}],
+        'folder/_view/byPathComponents': [],
+        'file/_view/byPathComponents': descendants,
+    }
+
+    def serve_view(request, uri, headers):
+        docs = views[uri.split('/_design/')[1].split('?')[0]]
+        rows = [{'id': doc['_id'], 'key': doc['_id'], 'value': None,
+                 'doc': doc} for doc in docs]
+        return (200, headers, json.dumps(
+            {'total_rows': len(rows), 'offset': 0, 'rows': rows}))
+
+    def serve_bulk_docs(request, uri, headers):
+        docs = json.loads(request.body)['docs']
+        deleted.extend(docs)
+        return (201, headers, json.dumps(
+            [{'id': doc['_id'], 'rev': '2-b'} for doc in docs]))
+
+    for view in views:
+        httpretty.register_uri(
+            httpretty.GET, DB_URL + '/_design/' + view,
+            body=serve_view, content_type='application/json')
+    httpretty.register_uri(
+        httpretty.POST, DB_URL + '/_bulk_docs',
+        body=serve_bulk_docs, content_type='application/json')
+    return deleted
+
+
+def test_rmdir(couch_fs):
+    deleted = serve_rmdir([])
+    assert 0 == couch_fs.rmdir('/a')
+    assert [{'_id': 'a', '_rev': '1-a', '_deleted': True}] == deleted
+    assert ['a'] == [doc['_id'] for doc in couch_fs.cache.deletes]
+
+
+def test_rmdir_not_empty(couch_fs):
+    # File replicated from the remote Cozy, not in the tree yet.
+    deleted = serve_rmdir([{'_id': 'x', '_rev': '1-a', 'path': '/a',
+                            'name': 'x', 'docType': 'File'}])
+    assert -errno.ENOTEMPTY == couch_fs.rmdir('/a')
+    assert [] == deleted
+
+    couch_fs.cache.children['/a'] = ['x']
+    assert -errno.ENOTEMPTY == couch_fs.rmdir('/a')
+    assert [] == deleted
+
+
+class Journal():
+
+    def __init__(self, requests):
+        self.requests = requests
+
+    def move(self, pathfrom, pathto):
+        self.requests.append(('move', pathfrom, pathto))
+
+
+def serve_rename(requests, conflict=False):
+    '''
+    Register answers of the requests made to rename file /a.txt.
+    '''
+    def serve_view(request, uri, headers):
+        rows = [{'id': 'x', 'key': '/a.txt', 'value': None,
+                 'doc': {'_id': 'x', '_rev': '1-a', 'path': '',
+                         'name': 'a.txt', 'docType': 'File'}}]
+        return (200, headers, json.dumps(
+            {'total_rows': 1, 'offset': 0, 'rows': rows}))
+
+    def serve_bulk_docs(request, uri, headers):
+        requests.append(('save',))
+        if conflict:
+            result = {'id': 'x', 'error': 'conflict', 'reason': 'conflict'}
+        else:
+            result = {'id': 'x', 'rev': '2-b'}
+        return (201, headers, json.dumps([result]))
+
+    httpretty.register_uri(
+        httpretty.GET, DB_URL + '/_design/file/_view/byFullPath',
+        body=serve_view, content_type='application/json')
+    httpretty.register_uri(
+        httpretty.POST, DB_URL + '/_bulk_docs',
+        body=serve_bulk_docs, content_type='application/json')
+
+
+def test_rename_moves_journal_once_saved(couch_fs):
+    requests = []
+    couch_fs.journal = Journal(requests)
+    serve_rename(requests)
+    assert 0 == couch_fs.rename('/a.txt', '/b.txt')
+    assert [('save',), ('move', '/a.txt', '/b.txt')] == requests
+
+
+def test_failed_rename_keeps_journal(couch_fs):
+    requests = []
+    couch_fs.journal = Journal(requests)
+    serve_rename(requests, conflict=True)
+    assert -errno.EIO == couch_fs.rename('/a.txt', '/b.txt')
+    assert [('save',)] == requests
+
+
+def test_save_file_without_document(couch_fs):
+    httpretty.register_uri(
+        httpretty.GET, DB_URL + '/_design/file/_view/byFullPath',
+        body=json.dumps({'total_rows': 0, 'offset': 0, 'rows': []}),
+        content_type='application/json')
+    with pytest.raises(IOError):
+        couch_fs._save_file('/a.txt', None, '2014-05-07T09:17:48')
+
+
+class WriteBuffer():
+
+    def __init__(self):
+        self.base = None
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_rename_open_file(couch_fs):
+    serve_rename([])
+    (moved, replaced) = (WriteBuffer(), WriteBuffer())
+    couch_fs.writeBuffers.update({'/a.txt': moved, '/b.txt': replaced})
+    couch_fs.openFiles['/a.txt'] = 1
+    couch_fs.readahead.positions['/a.txt'] = (10, 2)
+    assert 0 == couch_fs.rename('/a.txt', '/b.txt')
+    assert {'/b.txt': moved} == couch_fs.writeBuffers
+    assert {'/b.txt': 1} == couch_fs.openFiles
+    assert {'/b.txt': (10, 2)} == couch_fs.readahead.positions
+    assert replaced.closed and not moved.closed
+
+
+def test_move_paths():
+    items = {'/a': 1, '/a/b': 2, '/ab': 3, '/c/b': 4}
+    assert [4] == couchmount._move_paths(items, '/a', '/c')
+    assert {'/ab': 3, '/c': 1, '/c/b': 2} == items
@@ -1,7 +1,11 @@
 import pytest
 import sys
 import os
+import json
 import requests
+import httpretty
+
+from couchdb import Database, ResourceConflict
 
 sys.path.append('..')
 
@@ -16,6 +20,7 @@ local_config.CONFIG_PATH = \
 import cozyfuse.dbutils as dbutils
 
 TESTDB = 'cozy-fuse-test'
+DB_URL = 'http://localhost:5984/%s' % TESTDB
 
 
 @pytest.fixture(scope="module")
@@ -124,3 +129,299 @@ def test_remove_db_user():
 
 def test_clear_config():
     local_config.clear()
+
+
+def test_iter_view():
+    rows = [{'id': 'doc%s' % index, 'key': index // 2, 'value': index}
+            for index in range(7)]
+
+    def serve_view(request, uri, headers):
+        query = request.querystring
+        limit = int(query['limit'][0])
+        start = 0
+        if 'startkey' in query:
+            start = [(row['key'], row['id']) for row in rows].index(
+                (json.loads(query['startkey'][0]),
+                 query['startkey_docid'][0]))
+        body = {'total_rows': len(rows), 'offset': start,
+                'rows': rows[start:start + limit]}
+        return (200, headers, json.dumps(body))
+
+    httpretty.enable()
+    try:
+        httpretty.register_uri(
+            httpretty.GET, DB_URL + '/_design/file/_view/all',
+            body=serve_view, content_type='application/json')
+        values = [row.value for row in
+                  dbutils.iter_view(Database(DB_URL), 'file/all', 3)]
+        assert range(7) == values
+        assert 3 == len(httpretty.HTTPretty.latest_requests)
+    finally:
+        httpretty.disable()
+        httpretty.reset()
+
+
+def test_get_descendants():
+    docs = {
+        'folder': [{'_id': 'folder1', 'path': '/a', 'name': 'b'}],
+        'file': [{'_id': 'file1', 'path': '/a', 'name': 'c'},
+                 {'_id': 'file2', 'path': '/a/b', 'name': 'd'}],
+    }
+
+    def serve_view(request, uri, headers):
+        query = request.querystring
+        assert ['a'] == json.loads(query['startkey'][0])
+        assert ['a', {}] == json.loads(query['endkey'][0])
+        assert 'true' == query['include_docs'][0]
+        doc_type = uri.split('/_design/')[1].split('/')[0]
+        rows = [{'id': doc['_id'], 'key': ['a'], 'value': None, 'doc': doc}
+                for doc in docs[doc_type]]
+        body = {'total_rows': len(rows), 'offset': 0, 'rows': rows}
+        return (200, headers, json.dumps(body))
+
+    httpretty.enable()
+    try:
+        for doc_type in docs:
+            httpretty.register_uri(
+                httpretty.GET,
+                DB_URL + '/_design/%s/_view/byPathComponents' % doc_type,
+                body=serve_view, content_type='application/json')
+        descendants = dbutils.get_descendants(Database(DB_URL), '/a')
+        assert ['folder1', 'file1', 'file2'] == \
+            [doc['_id'] for doc in descendants]
+        assert 2 == len(httpretty.HTTPretty.latest_requests)
+    finally:
+        httpretty.disable()
+        httpretty.reset()
+
+
+def test_get_docs():
+    def serve_all_docs(request, uri, headers):
+        keys = json.loads(request.body)['keys']
+        assert ['doc1', 'missing', 'deleted'] == keys
+        rows = [
+            {'id': 'doc1', 'key': 'doc1', 'value': {'rev': '1-a'},
+             'doc': {'_id': 'doc1', '_rev': '1-a', 'name': 'file'}},
+            {'key': 'missing', 'error': 'not_found'},
+            {'id': 'deleted', 'key': 'deleted',
+             'value': {'rev': '2-b', 'deleted': True}, 'doc': None},
+        ]
+        body = {'total_rows': 3, 'offset': 0, 'rows': rows}
+        return (200, headers, json.dumps(body))
+
+    httpretty.enable()
+    try:
+        httpretty.register_uri(
+            httpretty.POST, DB_URL + '/_all_docs',
+            body=serve_all_docs, content_type='application/json')
+        db = Database(DB_URL)
+        docs = dbutils.get_docs(db, ['doc1', 'missing', 'deleted'])
+        assert ['doc1'] == docs.keys()
+        assert 'file' == docs['doc1']['name']
+        revs = dbutils.get_revs(db, ['doc1', 'missing', 'deleted'])
+        assert {'doc1': '1-a'} == revs
+    finally:
+        httpretty.disable()
+        httpretty.reset()
+
+
+def test_save_docs():
+    def serve_bulk_docs(request, uri, headers):
+        docs = json.loads(request.body)['docs']
+        results = [{'id': 'doc1', 'rev': '2-a'},
+                   {'id': 'doc2', 'error': 'conflict',
+                    'reason': 'Document update conflict.'}]
+        return (201, headers, json.dumps(results[:len(docs)]))
+
+    httpretty.enable()
+    try:
+        httpretty.register_uri(
+            httpretty.POST, DB_URL + '/_bulk_docs',
+            body=serve_bulk_docs, content_type='application/json')
+        docs = [{'_id': 'doc1', '_rev': '1-a'}, {'_id': 'doc2', '_rev': '1-b'}]
+        errors = dbutils.save_docs(Database(DB_URL), docs)
+        assert ['doc2'] == errors.keys()
+        assert isinstance(errors['doc2'], ResourceConflict)
+        assert '2-a' == docs[0]['_rev']
+        assert 1 == len(httpretty.HTTPretty.latest_requests)
+    finally:
+        httpretty.disable()
+        httpretty.reset()
+
+
+def test_get_server(monkeypatch):
+    reads = []
+
+    def get_db_credentials(name):
+        reads.append(name)
+        return ('login', 'password')
+
+    monkeypatch.setattr(local_config, 'get_db_credentials',
+                        get_db_credentials)
+    server = dbutils.get_server('shared-device')
+    assert server is dbutils.get_server('shared-device')
+    assert ('login', 'password') == server.resource.credentials
+    assert ['shared-device'] == reads
+    assert dbutils.get_server() is not server
+    assert dbutils.get_server().resource.credentials is None
+
+
+def test_connection_pool_size():
+    class Connection():
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    pool = dbutils.ConnectionPool(size=2)
+    conns = [Connection() for index in range(3)]
+    for conn in conns:
+        pool.release(DB_URL, conn)
+    assert 2 == len(pool.conns[('http', 'localhost:5984')])
+    assert [False, False, True] == [conn.closed for conn in conns]
+
+
+def test_init_database_view_migration():
+    saved = []
+
+    def serve_put(request, uri, headers):
+        saved.append(json.loads(request.body))
+        return (201, headers, json.dumps(
+            {'ok': True, 'id': '_design/file', 'rev': '2-b'}))
+
+    old_design = {
+        '_id': '_design/file', '_rev': '1-a',
+        'views': {'all': {'map': 'function (doc) { emit(doc._id, doc) }'}},
+    }
+    httpretty.enable()
+    try:
+        httpretty.register_uri(
+            httpretty.GET, DB_URL + '/_design/file',
+            body=json.dumps(old_design), content_type='application/json')
+        httpretty.register_uri(
+            httpretty.PUT, DB_URL + '/_design/file',
+            body=serve_put, content_type='application/json')
+        dbutils.init_database_view('File', Database(DB_URL))
+        assert 1 == len(saved)
+        assert '1-a' == saved[0]['_rev']
+        assert 'emit(doc._id, null)' in saved[0]['views']['all']['map']
+    finally:
+        httpretty.disable()
+        httpretty.reset()
+
+
+def test_create_docs():
+    bodies = []
+
+    def serve_bulk_docs(request, uri, headers):
+        bodies.append(json.loads(request.body))
+        return (201, headers, json.dumps([]))
+
+    httpretty.enable()
+    try:
+        httpretty.register_uri(
+            httpretty.POST, DB_URL + '/_bulk_docs',
+            body=serve_bulk_docs, content_type='application/json')
+        binary = {'_id': dbutils.get_new_id(), '_rev': '1-abc'}
+        file_doc = {'_id': dbutils.get_new_id(),
+                    'binary': {'file': {'id': binary['_id'], 'rev': '1-abc'}}}
+        dbutils.create_docs(Database(DB_URL), [binary, file_doc])
+        assert 1 == len(bodies)
+        assert bodies[0]['new_edits'] is False
+        assert '1-abc' == bodies[0]['docs'][0]['_rev']
+        assert file_doc['_rev'].startswith('1-')
+        assert file_doc['_rev'] == bodies[0]['docs'][1]['_rev']
+    finally:
+        httpretty.disable()
+        httpretty.reset()
+
+
+def test_get_orphan_binaries():
+    views = {
+        'binary': [{'id': binary_id, 'key': binary_id, 'value': None}
+                   for binary_id in ['binary1', 'binary2', 'binary3']],
+        'file': [
+            {'id': 'file1', 'key': 'file1', 'value': None,
+             'doc': {'_id': 'file1', 'binary': {'file': {'id': 'binary1'}}}},
+            {'id': 'file2', 'key': 'file2', 'value': None,
+             'doc': {'_id': 'file2'}},
+        ],
+    }
+
+    def serve_view(request, uri, headers):
+        rows = views[uri.split('/_design/')[1].split('/')[0]]
+        body = {'total_rows': len(rows), 'offset': 0, 'rows': rows}
+        return (200, headers, json.dumps(body))
+
+    httpretty.enable()
+    try:
+        for doc_type in views:
+            httpretty.register_uri(
+                httpretty.GET, DB_URL + '/_design/%s/_view/all' % doc_type,
+                body=serve_view, content_type='application/json')
+        orphans = dbutils.get_orphan_binaries(Database(DB_URL))
+        assert set(['binary2', 'binary3']) == orphans
+    finally:
+        httpretty.disable()
+        httpretty.reset()
+
+
+def test_delete_docs_by_id():
+    deleted = []
+
+    def serve_all_docs(request, uri, headers):
+        rows = [{'id': 'doc1', 'key': 'doc1', 'value': {'rev': '3-c'}},
+                {'key': 'missing', 'error': 'not_found'}]
+        return (200, headers, json.dumps(
+            {'total_rows': 1, 'offset': 0, 'rows': rows}))
+
+    def serve_bulk_docs(request, uri, headers):
+        docs = json.loads(request.body)['docs']
+        deleted.extend(docs)
+        return (201, headers, json.dumps(
+            [{'id': doc['_id'], 'rev': '4-d'} for doc in docs]))
+
+    httpretty.enable()
+    try:
+        httpretty.register_uri(
+            httpretty.POST, DB_URL + '/_all_docs',
+            body=serve_all_docs, content_type='application/json')
+        httpretty.register_uri(
+            httpretty.POST, DB_URL + '/_bulk_docs',
+            body=serve_bulk_docs, content_type='application/json')
+        errors = dbutils.delete_docs_by_id(
+            Database(DB_URL), ['doc1', 'missing'])
+        assert {} == errors
+        assert [{'_id': 'doc1', '_rev': '3-c', '_deleted': True}] == deleted
+    finally:
+        httpretty.disable()
+        httpretty.reset()
+
+
+def test_get_db_uuid():
+    local_docs = {}
+
+    def serve_get(request, uri, headers):
+        if 'uuid' not in local_docs:
+            return (404, headers, json.dumps({'error': 'not_found'}))
+        return (200, headers, json.dumps(local_docs))
+
+    def serve_put(request, uri, headers):
+        local_docs.update(json.loads(request.body))
+        return (201, headers, json.dumps(
+            {'ok': True, 'id': '_local/cozyfuse', 'rev': '0-1'}))
+
+    httpretty.enable()
+    try:
+        httpretty.register_uri(
+            httpretty.GET, DB_URL + '/_local/cozyfuse',
+            body=serve_get, content_type='application/json')
+        httpretty.register_uri(
+            httpretty.PUT, DB_URL + '/_local/cozyfuse',
+            body=serve_put, content_type='application/json')
+        db_uuid = dbutils.get_db_uuid(Database(DB_URL))
+        assert local_docs['uuid'] == db_uuid
+        assert db_uuid == dbutils.get_db_uuid(Database(DB_URL))
+    finally:
+        httpretty.disable()
+        httpretty.reset()
@@ -0,0 +1,74 @@
+import sys
+import os
+import time
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+
+import cozyfuse.folderdates as folderdates
+
+
+class Saver():
+
+    def __init__(self, failed=[]):
+        self.saves = []
+        self.failed = failed
+
+    def save(self, dates):
+        self.saves.append(dates)
+        return [path for path in self.failed if path in dates]
+
+
+def test_changes_are_coalesced():
+    saver = Saver()
+    dates = folderdates.FolderDates(saver.save)
+    for index in range(100):
+        dates.set('/a', '2014-05-07T09:17:%02d' % (index % 60))
+        dates.set('/b', '2014-05-07T09:18:00')
+    assert '2014-05-07T09:17:39' == dates.get('/a')
+    dates.flush()
+    assert [{'/a': '2014-05-07T09:17:39',
+             '/b': '2014-05-07T09:18:00'}] == saver.saves
+    assert dates.get('/a') is None
+    dates.flush()
+    assert 1 == len(saver.saves)
+
+
+def test_failed_saves_are_retried():
+    saver = Saver(failed=['/a'])
+    dates = folderdates.FolderDates(saver.save)
+    dates.set('/a', '2014-05-07T09:17:00')
+    dates.set('/b', '2014-05-07T09:17:00')
+    dates.flush()
+    assert '2014-05-07T09:17:00' == dates.get('/a')
+    assert dates.get('/b') is None
+
+
+def test_move_and_discard():
+    saver = Saver()
+    dates = folderdates.FolderDates(saver.save)
+    dates.set('/a', '2014-05-07T09:17:00')
+    dates.set('/a/b', '2014-05-07T09:17:01')
+    dates.set('/ab', '2014-05-07T09:17:02')
+    dates.move('/a', '/c')
+    assert ['/ab', '/c', '/c/b'] == sorted(dates.pending)
+    dates.discard('/c')
+    assert ['/ab'] == sorted(dates.pending)
+
+
+def test_background_flush():
+    saver = Saver()
+    dates = folderdates.FolderDates(saver.save, delay=0.05)
+    dates.start()
+    dates.set('/a', '2014-05-07T09:17:00')
+    start = time.time()
+    while not saver.saves and time.time() - start < 5:
+        time.sleep(0.01)
+    assert [{'/a': '2014-05-07T09:17:00'}] == saver.saves
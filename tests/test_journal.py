@@ -0,0 +1,171 @@
+import pytest
+import sys
+import os
+import time
+import shutil
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+
+import cozyfuse.journal as journal
+import cozyfuse.writebuffer as writebuffer
+
+FOLDER = os.path.join(local_config.CONFIG_FOLDER, 'journal')
+BUFFER_FOLDER = os.path.join(local_config.CONFIG_FOLDER, 'buffers')
+
+
+class Committer():
+
+    def __init__(self, failures={}):
+        self.commits = []
+        # path -> number of commits of this path that fail.
+        self.failures = dict(failures)
+
+    def commit(self, path, entry, date):
+        if self.failures.get(path):
+            self.failures[path] -= 1
+            raise IOError('Database unavailable')
+        self.commits.append((path, entry.stream().read(), date))
+
+
+@pytest.fixture
+def committer(request):
+    for folder in [FOLDER, BUFFER_FOLDER]:
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+    writebuffer.clean(BUFFER_FOLDER)
+    return Committer()
+
+
+def add(file_journal, path, data, date='2014-05-07T09:17:48'):
+    write_buffer = writebuffer.WriteBuffer(BUFFER_FOLDER, spill_size=4)
+    write_buffer.write(data, 0)
+    file_journal.add(path, write_buffer, date)
+    write_buffer.close()
+
+
+def wait_commits(file_journal, committer, count):
+    for index in range(100):
+        if len(committer.commits) >= count and not file_journal.pending \
+                and file_journal.committing is None:
+            return
+        time.sleep(0.01)
+
+
+def test_add_and_get(committer):
+    file_journal = journal.Journal(FOLDER, committer.commit)
+    add(file_journal, '/a.txt', 'abc')
+    add(file_journal, '/b.txt', 'big content')
+    assert 'bc' == file_journal.get('/a.txt').read(2, 1)
+    assert 11 == file_journal.get('/b.txt').size
+    assert file_journal.get('/c.txt') is None
+    assert [] == os.listdir(BUFFER_FOLDER)
+
+
+def test_coalesce(committer):
+    file_journal = journal.Journal(FOLDER, committer.commit)
+    add(file_journal, '/a.txt', 'abc')
+    add(file_journal, '/a.txt', 'def')
+    assert ['/a.txt'] == file_journal.pending.keys()
+    assert 2 == len(os.listdir(FOLDER))
+    assert 'def' == file_journal.get('/a.txt').read(3, 0)
+
+
+def test_commit_in_order(committer):
+    file_journal = journal.Journal(FOLDER, committer.commit)
+    add(file_journal, '/a.txt', 'abc', 'date1')
+    add(file_journal, '/b.txt', 'def', 'date2')
+    file_journal.start()
+    add(file_journal, '/c.txt', 'ghi', 'date3')
+    wait_commits(file_journal, committer, 3)
+    assert [('/a.txt', 'abc', 'date1'),
+            ('/b.txt', 'def', 'date2'),
+            ('/c.txt', 'ghi', 'date3')] == committer.commits
+    assert [] == os.listdir(FOLDER)
+
+
+def test_reload(committer):
+    file_journal = journal.Journal(FOLDER, committer.commit)
+    add(file_journal, '/a.txt', 'abc')
+    add(file_journal, '/b.txt', 'def')
+    add(file_journal, '/a.txt', 'ghi')
+    # Interrupted add
+    open(os.path.join(FOLDER, '%020d.data' % 10), 'w').close()
+
+    reloaded = journal.Journal(FOLDER, committer.commit)
+    assert ['/b.txt', '/a.txt'] == reloaded.pending.keys()
+    assert 'ghi' == reloaded.get('/a.txt').read(3, 0)
+    assert 4 == len(os.listdir(FOLDER))
+    add(reloaded, '/c.txt', 'jkl')
+    assert 4 == reloaded.get('/c.txt').seq
+
+
+def test_move_and_discard(committer):
+    file_journal = journal.Journal(FOLDER, committer.commit)
+    add(file_journal, '/folder/a.txt', 'abc')
+    add(file_journal, '/b.txt', 'def')
+    file_journal.move('/folder', '/other')
+    assert file_journal.get('/folder/a.txt') is None
+    assert 'abc' == file_journal.get('/other/a.txt').read(3, 0)
+
+    file_journal.discard('/b.txt')
+    assert ['/other/a.txt'] == file_journal.pending.keys()
+    reloaded = journal.Journal(FOLDER, committer.commit)
+    assert ['/other/a.txt'] == reloaded.pending.keys()
+
+
+def test_failed_commit_is_retried_after_others(committer, monkeypatch):
+    monkeypatch.setattr(journal, 'RETRY_DELAY', 0.05)
+    committer.failures['/a.txt'] = 2
+    file_journal = journal.Journal(FOLDER, committer.commit)
+    add(file_journal, '/a.txt', 'abc', 'date1')
+    add(file_journal, '/b.txt', 'def', 'date2')
+    file_journal.start()
+    wait_commits(file_journal, committer, 2)
+    assert [('/b.txt', 'def', 'date2'),
+            ('/a.txt', 'abc', 'date1')] == committer.commits
+    assert [] == os.listdir(FOLDER)
+
+
+def test_pinned_entry_outlives_commit(committer):
+    file_journal = journal.Journal(FOLDER, committer.commit)
+    add(file_journal, '/a.txt', 'abcdef')
+    entry = file_journal.pin('/a.txt')
+    write_buffer = writebuffer.WriteBuffer(
+        BUFFER_FOLDER, entry, spill_size=4, block_size=2)
+    write_buffer.write('X', 0)
+    file_journal.start()
+    wait_commits(file_journal, committer, 1)
+    assert file_journal.get('/a.txt') is None
+
+    file_journal.add('/a.txt', write_buffer, '2014-05-07T09:17:49')
+    write_buffer.close()
+    file_journal.unpin(entry)
+    wait_commits(file_journal, committer, 2)
+    assert ('/a.txt', 'Xbcdef', '2014-05-07T09:17:49') == \
+        committer.commits[1]
+    assert [] == os.listdir(FOLDER)
+
+
+def test_entry_discarded_while_committed(committer, monkeypatch):
+    monkeypatch.setattr(journal, 'RETRY_DELAY', 0.05)
+    file_journal = journal.Journal(FOLDER, None)
+
+    def commit(path, entry, date):
+        # File is removed while its content is saved.
+        file_journal.discard(path)
+        raise IOError('No document for %s' % path)
+
+    file_journal.commit = commit
+    add(file_journal, '/a.txt', 'abc')
+    file_journal.start()
+    wait_commits(file_journal, committer, 0)
+    assert file_journal.get('/a.txt') is None
+    assert [] == os.listdir(FOLDER)
@@ -74,6 +74,15 @@ def test_no_config(config_file):
                   'test-no-device')
 
 
+def test_remove_config(config_file):
+    folder = os.path.join(local_config.CONFIG_FOLDER, 'test-device')
+    os.makedirs(os.path.join(folder, 'cache'))
+    touch(os.path.join(folder, 'tree.snapshot'))
+    local_config.remove_config('test-device')
+    assert not os.path.exists(folder)
+    assert 'test-device' not in local_config.get_full_config()
+
+
 def test_clear_config(config_file):
     local_config.clear()
     assert False == os.path.isfile(local_config.CONFIG_PATH)
@@ -0,0 +1,81 @@
+import pytest
+import sys
+import os
+import shutil
+import httpretty
+
+from couchdb import Database
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+
+import cozyfuse.binarycache as binarycache
+import cozyfuse.readahead as readahead
+
+from test_binarycache import TESTDB, DB_URL, CONTENT, BLOCK_SIZE, serve_range
+
+
+@pytest.fixture
+def reader(request):
+    folder = os.path.join(local_config.CONFIG_FOLDER, TESTDB, 'cache')
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+
+    httpretty.enable()
+    httpretty.register_uri(httpretty.GET, DB_URL + '/binary1/file',
+                           body=serve_range)
+
+    def fin():
+        httpretty.disable()
+        httpretty.reset()
+    request.addfinalizer(fin)
+
+    cache = binarycache.BinaryCache(Database(DB_URL), TESTDB,
+                                    block_size=BLOCK_SIZE)
+    # HTTPretty does not support concurrent requests.
+    return readahead.ReadAhead(cache, window=4, workers=1)
+
+
+def test_sequential_read(reader):
+    assert CONTENT[:512] == reader.read('/file', 'binary1', '1-a', 512, 0)
+    reader.queue.join()
+    entry = reader.binary_cache.entries.values()[0]
+    assert set([0, 1, 2, 3, 4]) == entry.blocks
+
+    assert CONTENT[512:1024] == \
+        reader.read('/file', 'binary1', '1-a', 512, 512)
+    assert CONTENT[1024:2048] == \
+        reader.read('/file', 'binary1', '1-a', 1024, 1024)
+    assert CONTENT[2048:3072] == \
+        reader.read('/file', 'binary1', '1-a', 1024, 2048)
+    assert 5 == len(httpretty.HTTPretty.latest_requests)
+    assert CONTENT[3072:4096] == \
+        reader.read('/file', 'binary1', '1-a', 1024, 3072)
+    reader.queue.join()
+    assert set(range(8)) == entry.blocks
+
+
+def test_random_read(reader):
+    reader.read('/file', 'binary1', '1-a', 512, 4200)
+    reader.queue.join()
+    entry = reader.binary_cache.entries.values()[0]
+    assert set([4]) == entry.blocks
+    assert 1 == len(httpretty.HTTPretty.latest_requests)
+
+
+def test_read_ahead_stops_at_end_of_file(reader):
+    for offset in range(0, len(CONTENT), 1024):
+        assert CONTENT[offset:offset + 1024] == \
+            reader.read('/file', 'binary1', '1-a', 1024, offset)
+    reader.queue.join()
+    entry = reader.binary_cache.entries.values()[0]
+    assert entry.block_count() == len(entry.blocks)
+    reader.forget('/file')
+    assert {} == reader.positions
@@ -0,0 +1,163 @@
+import pytest
+import sys
+import os
+import shutil
+import threading
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+# Tree stats are FUSE stats.
+pytest.importorskip('fuse')
+
+import cozyfuse.tree as tree
+
+TESTDB = 'cozy-fuse-test'
+
+
+class Row():
+
+    def __init__(self, doc):
+        self.id = doc['_id']
+        self.key = doc['_id']
+        self.value = None
+        self.doc = doc
+
+
+class Database():
+    '''
+    Database holding the given documents, answering the requests made by
+    the tree when it is loaded.
+    '''
+
+    def __init__(self, docs, update_seq=10, uuid='uuid1'):
+        self.docs = docs
+        self.update_seq = update_seq
+        self.local_docs = {'_local/cozyfuse': {'uuid': uuid}}
+
+    def info(self):
+        return {'update_seq': self.update_seq}
+
+    def view(self, name, **options):
+        doc_type = name.split('/')[0]
+        return [Row(doc) for doc in self.docs
+                if doc['docType'].lower() == doc_type]
+
+    def changes(self, **options):
+        return {'results': []}
+
+    def get(self, id):
+        return self.local_docs.get(id)
+
+
+def folder(id, path, name):
+    return {'_id': id, 'docType': 'Folder', 'path': path, 'name': name}
+
+
+def file(id, path, name):
+    return {'_id': id, 'docType': 'File', 'path': path, 'name': name,
+            'size': 3, 'binary': {'file': {'id': 'binary-' + id,
+                                           'rev': '1-a'}}}
+
+
+@pytest.fixture
+def load(request, monkeypatch):
+    config_folder = os.path.join(local_config.CONFIG_FOLDER, 'tree')
+    if os.path.isdir(config_folder):
+        shutil.rmtree(config_folder)
+    monkeypatch.setattr(tree, 'CONFIG_FOLDER', config_folder)
+
+    def load(docs, **options):
+        db = Database(docs, **options)
+        monkeypatch.setattr(tree.dbutils, 'Databases',
+                            lambda database: type('', (), {'db': db})())
+        return tree.Cache(TESTDB)
+    return load
+
+
+def test_load(load):
+    cache = load([folder('a', '', 'a'), file('x', '/a', 'x'),
+                  file('y', '', 'y')])
+    assert ['a', 'y'] == cache.get_children('/')
+    assert ['x'] == cache.get_children('/a')
+    assert tree.FOLDER_MODE == cache.get_st('/a').st_mode
+    assert 3 == cache.get_st('/a/x').st_size
+    assert {'id': 'binary-x', 'rev': '1-a'} == cache.get_binary('/a/x')
+    assert cache.get_st('/a/z') is None
+    assert cache.find_file('/a', 'x')
+
+
+def test_update_and_delete(load):
+    cache = load([folder('a', '', 'a'), file('x', '/a', 'x')])
+    cache.update_document(folder('a', '', 'b'))
+    assert ['b'] == cache.get_children('/')
+    assert ['x'] == cache.get_children('/b')
+    assert '/b/x' == cache.nodes['x'].get_path()
+
+    cache.delete_document(folder('a', '', 'b'))
+    assert [] == cache.get_children('/')
+    assert {} == cache.nodes
+
+
+def test_children_moved_before_their_folder(load):
+    cache = load([folder('a', '', 'a'), file('x', '/a', 'x'),
+                  file('y', '/a', 'y')])
+    cache.update_document(file('x', '/b', 'x'))
+    cache.update_document(folder('a', '', 'b'))
+    assert ['b'] == cache.get_children('/')
+    assert ['x', 'y'] == cache.get_children('/b')
+    assert '/b/x' == cache.nodes['x'].get_path()
+
+
+def test_folders_without_document_are_hidden(load):
+    cache = load([file('x', '/missing', 'x'), file('y', '', 'y')])
+    assert ['y'] == cache.get_children('/')
+    assert ['y'] == [name for (name, file_type, inode)
+                     in cache.get_entries('/')]
+    assert not cache.find_file('/', 'missing')
+    assert cache.get_st('/missing') is None
+
+    cache.update_document(folder('m', '', 'missing'))
+    assert ['missing', 'y'] == cache.get_children('/')
+    assert ['x'] == cache.get_children('/missing')
+
+
+def test_snapshot(load):
+    load([folder('a', '', 'a'), file('x', '/a', 'x')])
+    reloaded = load([])
+    assert ['x'] == reloaded.get_children('/a')
+    assert {'id': 'binary-x', 'rev': '1-a'} == reloaded.get_binary('/a/x')
+
+
+def test_snapshot_of_another_database(load):
+    load([folder('a', '', 'a'), file('x', '/a', 'x')])
+    reloaded = load([folder('b', '', 'b')], uuid='uuid2')
+    assert ['b'] == reloaded.get_children('/')
+
+
+def test_concurrent_snapshots(load):
+    cache = load([folder('a', '', 'a'), file('x', '/a', 'x')])
+    errors = []
+
+    def save():
+        for index in range(20):
+            try:
+                with cache.lock:
+                    cache.last_seq += 1
+                cache.save_snapshot()
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=save) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [] == errors
+    assert cache.last_seq == load([], update_seq=100).last_seq
@@ -0,0 +1,151 @@
+import pytest
+import sys
+import os
+import shutil
+import threading
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+
+import cozyfuse.writebuffer as writebuffer
+
+FOLDER = os.path.join(local_config.CONFIG_FOLDER, 'buffers')
+
+
+@pytest.fixture
+def folder(request):
+    if os.path.isdir(FOLDER):
+        shutil.rmtree(FOLDER)
+    writebuffer.clean(FOLDER)
+    return FOLDER
+
+
+def test_sequential_write(folder):
+    write_buffer = writebuffer.WriteBuffer(folder)
+    assert 3 == write_buffer.write('abc', 0)
+    assert 3 == write_buffer.write('def', 3)
+    assert 6 == write_buffer.size
+    assert 'abcdef' == write_buffer.getvalue()
+    assert write_buffer.path is None
+    write_buffer.close()
+
+
+def test_write_at_offset(folder):
+    write_buffer = writebuffer.WriteBuffer(folder)
+    write_buffer.write('abc', 0)
+    write_buffer.write('X', 1)
+    write_buffer.write('end', 6)
+    assert 9 == write_buffer.size
+    assert 'aXc\x00\x00\x00end' == write_buffer.getvalue()
+    write_buffer.close()
+
+
+def test_spill(folder):
+    write_buffer = writebuffer.WriteBuffer(folder, spill_size=10)
+    write_buffer.write('abcdef', 0)
+    assert write_buffer.path is None
+    write_buffer.write('ghijkl', 6)
+    assert write_buffer.path is not None
+    assert os.path.isfile(write_buffer.path)
+    write_buffer.write('X', 0)
+    assert 'Xbcdefghijkl' == write_buffer.getvalue()
+
+    path = write_buffer.path
+    write_buffer.close()
+    assert not os.path.exists(path)
+
+
+def test_clean(folder):
+    write_buffer = writebuffer.WriteBuffer(folder, spill_size=0)
+    write_buffer.write('abc', 0)
+    writebuffer.clean(folder)
+    assert [] == os.listdir(folder)
+
+
+def test_stream(folder):
+    write_buffer = writebuffer.WriteBuffer(folder, spill_size=4)
+    write_buffer.write('abc', 0)
+    assert 'abc' == write_buffer.stream().read()
+    write_buffer.write('def', 3)
+    assert 'abcdef' == write_buffer.stream().read()
+    write_buffer.close()
+
+
+class Base():
+
+    def __init__(self, content):
+        self.content = content
+        self.reads = []
+
+    def get_size(self):
+        return len(self.content)
+
+    def read(self, size, offset):
+        self.reads.append((size, offset))
+        return self.content[offset:offset + size]
+
+
+def test_partial_write_copies_edge_blocks(folder):
+    base = Base('abcdefghij')
+    write_buffer = writebuffer.WriteBuffer(folder, base, block_size=4)
+    write_buffer.write('XY', 5)
+    assert [(4, 4)] == base.reads
+    assert 'abcdeXYhij' == write_buffer.read(10, 0)
+    assert 'abcdeXYhij' == write_buffer.getvalue()
+    write_buffer.close()
+
+
+def test_full_block_write_does_not_read_base(folder):
+    base = Base('abcdefghij')
+    write_buffer = writebuffer.WriteBuffer(folder, base, block_size=4)
+    write_buffer.write('WXYZ', 4)
+    assert [] == base.reads
+    assert 'cdWXYZij' == write_buffer.read(8, 2)
+    write_buffer.close()
+
+
+def test_truncate(folder):
+    base = Base('abcdefghij')
+    write_buffer = writebuffer.WriteBuffer(folder, base, block_size=4)
+    write_buffer.truncate(0)
+    write_buffer.write('new', 0)
+    assert 'new' == write_buffer.getvalue()
+    assert [] == base.reads
+    write_buffer.close()
+
+    write_buffer = writebuffer.WriteBuffer(folder, base, block_size=4)
+    write_buffer.truncate(6)
+    assert 6 == write_buffer.get_size()
+    assert 'abcdef' == write_buffer.getvalue()
+    write_buffer.truncate(8)
+    assert 'abcdef\x00\x00' == write_buffer.read(8, 0)
+    write_buffer.close()
+
+
+def test_concurrent_writes(folder):
+    base = Base('a' * 4000)
+    write_buffer = writebuffer.WriteBuffer(folder, base, spill_size=1000,
+                                           block_size=100)
+
+    def write(char):
+        for offset in range(0, 4000, 50):
+            write_buffer.write(char * 10, offset + 10 * (ord(char) - ord('b')))
+
+    threads = [threading.Thread(target=write, args=(char,))
+               for char in 'bcd']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    content = write_buffer.getvalue()
+    assert 4000 == len(content)
+    assert 80 * ('bbbbbbbbbbccccccccccdddddddddd' + 'a' * 20) == content
+    write_buffer.close()